@@ -352,7 +352,7 @@ def plot_raster_single_trial(one, eid, trial_number, probe):
     'stimOn_times','feedback_times' and 'stimOff_times'
     '''
     
-    dataset_types = ['clusters.depth','spikes.times', 'spikes.depths','spikes.clusters', 'trials.intervals']   
+    dataset_types = ['clusters.depths','spikes.times', 'spikes.depths','spikes.clusters', 'trials.intervals']   
     
     D = one.load(eid, dataset_types = dataset_types, dclass_output=True)
     
@@ -363,6 +363,7 @@ def plot_raster_single_trial(one, eid, trial_number, probe):
     probe_path = alf_path / probe
 
     spikes = alf.io.load_object(probe_path, 'spikes')
+    clusters = alf.io.load_object(probe_path, 'clusters')
     trials = alf.io.load_object(alf_path, 'trials')   
     
     T_BIN = 0.01  # time bin in sec
@@ -372,11 +373,10 @@ def plot_raster_single_trial(one, eid, trial_number, probe):
     R, times, Clusters = bincount2D(
         spikes['times'], spikes['clusters'], T_BIN)
 
-    # Order activity by cortical depth of neurons
-    d = dict(zip(spikes['clusters'], spikes['depths']))
-    y = sorted([[i, d[i]] for i in d])
-    isort = np.argsort([x[1] for x in y])
+    # Order activity by cortical depth of neurons (clusters.depths is indexed by cluster id)
+    isort = np.argsort(clusters['depths'][Clusters.astype(np.int64)], kind='stable')
     R = R[isort, :]
+    Clusters = Clusters[isort]
 
     # get trial number for each time bin
     trial_numbers = np.digitize(times, trials['intervals'][:,0])
@@ -392,7 +392,7 @@ def plot_raster_single_trial(one, eid, trial_number, probe):
     plt.imshow(R[:, first:last], aspect='auto',
                cmap='binary', vmax=T_BIN / 0.001 / 4,
                extent=np.r_[times[[first, last]],
-               Clusters[[0, -1]]], origin='lower')
+               [np.min(Clusters), np.max(Clusters)]], origin='lower')
 
 
 
@@ -405,15 +405,15 @@ def plot_raster_single_trial(one, eid, trial_number, probe):
         return li
 
     iblplt.vertical_lines(restrict_timestamplist(
-        trials['stimOn_times']), ymin=0, ymax=Clusters[-1],
+        trials['stimOn_times']), ymin=0, ymax=np.max(Clusters),
         color='m', linewidth=0.5, label='stimOn_times')
 
     iblplt.vertical_lines(restrict_timestamplist(
-        trials['feedback_times']), ymin=0, ymax=Clusters[-1],
+        trials['feedback_times']), ymin=0, ymax=np.max(Clusters),
         color='b', linewidth=0.5, label='feedback_times')
 
 #    iblplt.vertical_lines(restrict_timestamplist(
-#        trials['stimOff_times']), ymin=0, ymax=Clusters[-1],
+#        trials['stimOff_times']), ymin=0, ymax=np.max(Clusters),
 #        color='g', linewidth=0.5, label='stimOff_times')
 
     plt.xlabel('Time (s)')
@@ -0,0 +1,117 @@
+"""
+On-disk cache for intermediate results (e.g. receptive fields).
+
+Each result is stored in its own directory, `<cache_dir>/<name>/<key>`, where `key` is a hash of
+all inputs the result was computed from; changing any input therefore results in a new key rather
+than a stale result. Changes of the code are not detected: each type of result has a version
+constant that is passed to `hash_inputs` (e.g. `rf_mapping.RFS_CACHE_VERSION`), and which must be
+incremented whenever the results, or the way they are stored, change.
+"""
+
+import os
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path.home() / '.v1_protocol' / 'cache'
+# part of every key; increment it whenever the keys or the layout of the cache change
+CACHE_VERSION = 1
+
+
+def hash_inputs(*arrays, **params):
+    """
+    Hash arrays and parameters into a key for the cache
+
+    Parameters
+    ----------
+    *arrays : array-like
+        arrays the result is computed from; the key depends on their dtypes, shapes and values
+    **params
+        parameters the result is computed with, including the version of the code computing it;
+        the key depends on their `repr`
+
+    Returns
+    -------
+    str
+        hexadecimal hash
+
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(('cache_version', CACHE_VERSION)).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(repr((array.dtype.str, array.shape)).encode())
+        h.update(array.data)
+    for key in sorted(params):
+        h.update(repr((key, params[key])).encode())
+    return h.hexdigest()
+
+
+def get_file_signature(paths):
+    """
+    Cheap fingerprint of a set of files: their names, sizes and modification times; unlike a hash
+    of their contents, it does not require reading (possibly very large) files, but it does not
+    detect a change of contents that keeps both the size and the modification time (e.g. a file
+    restored from a copy that preserves timestamps)
+
+    Parameters
+    ----------
+    paths : iterable of str or Path
+
+    Returns
+    -------
+    tuple
+        can be passed as a parameter to `hash_inputs`
+
+    """
+    signature = []
+    for path in sorted(str(p) for p in paths):
+        stat = os.stat(path)
+        signature.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def get_cache_path(name, key, cache_dir=None):
+    """
+    Path of the cache directory of a single result
+
+    Parameters
+    ----------
+    name : str
+        type of result (e.g. 'rfs'); results of each type are stored in their own subdirectory
+    key : str
+        output of `hash_inputs`
+    cache_dir : str or Path or NoneType, optional
+        root cache directory; if `NoneType`, `DEFAULT_CACHE_DIR` is used
+
+    Returns
+    -------
+    Path
+
+    """
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    return Path(cache_dir).joinpath(name, key)
+
+
+def save_to_cache(path, save):
+    """
+    Save a result into a cache directory; the result is written to a temporary directory first so
+    that an interrupted save never leaves a partial result behind
+
+    Parameters
+    ----------
+    path : Path
+        output of `get_cache_path`
+    save : callable
+        function that takes a directory and writes the result into it
+
+    """
+    path = Path(path)
+    tmp_path = path.with_name('%s.%i.tmp' % (path.name, os.getpid()))
+    save(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # the same result was saved by another process in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -1,11 +1,42 @@
 from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
-from oneibl.one import ONE
 import alf.io
 import scipy.stats
+try:
+    from stim_info import load_stim_info
+except ImportError:
+    from v1_protocol.stim_info import load_stim_info
 plt.ion()
 
+def get_depth_sorted_raster(spike_times, spike_clusters, cluster_depths, bin_size):
+
+    '''
+    Bin the spikes of each cluster in time and order the rows of the
+    resulting raster by cluster depth; clusters at the same depth
+    keep their order of increasing cluster id
+
+    :param spike_times: spike times (s)
+    :type spike_times: 1D array
+    :param spike_clusters: cluster id of each spike
+    :type spike_clusters: 1D array
+    :param cluster_depths: depth of each cluster, indexed by cluster id,
+        e.g. clusters = alf.io.load_object(alf_path, 'clusters'); clusters['depths']
+    :type cluster_depths: 1D array
+    :param bin_size: width of time bins (s)
+    :type bin_size: float
+    :return: raster of shape (n_clusters, n_bins) with rows sorted by depth,
+        bin times, and cluster ids in row order
+    :rtype: tuple
+    '''
+
+    from brainbox.processing import bincount2D
+    raster, times, cluster_ids = bincount2D(spike_times, spike_clusters, bin_size)
+    isort = np.argsort(
+        np.asarray(cluster_depths)[cluster_ids.astype(np.int64)], kind='stable')
+    return raster[isort, :], times, cluster_ids[isort]
+
+
 def scatter_raster(spikes, clusters=None, boundary_times=None, ax=None, downsample_factor=25):
  
     '''
@@ -75,24 +106,11 @@ def get_stimulus_type_boundary_times(alf_path):
     '''
     from the _iblcertif_*times* files in alf,
     create dictionary of stimuls type names
-    and start/end times
+    and start/end times (parsed once per session,
+    see stim_info.load_stim_info)
     '''
 
-    times = list(Path(alf_path).rglob('_iblcertif_*times*'))
-
-    T ={}
-    for t in times:
-        name = '.'.join(str(t).split('/')[-1].split('.')[1:4])        
-        T[name] = np.load(t)
-
-    T2 = {}
-    for i in T:
-        if len(T[i].shape) == 2:
-            T2[i] = [T[i][0][0], T[i][-1][-1]]
-        if len(T[i].shape) == 1:
-            T2[i] = [T[i][0], T[i][-1]]
-
-    return T2
+    return dict(load_stim_info(alf_path)['boundary_times'])
 
 
 def scatter_with_boundary_times(alf_probe_path, clusters=None, ax=None):
@@ -108,6 +126,7 @@ def scatter_with_boundary_times(alf_probe_path, clusters=None, ax=None):
 
 #if __name__ == '__main__':
 
+#    from oneibl.one import ONE
 #    one = ONE()
 #    eid = one.search(subject='ZM_2104', date='2019-09-19', number=1)
 #    #eid = one.search(subject='ZM_2407', date='2019-11-05', number=3) #depth per spike but no times
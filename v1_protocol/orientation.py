@@ -1,13 +1,19 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import warnings
 import alf.io as ioalf
-from brainbox.processing import bincount2D
 from brainbox.singlecell import calculate_peths
 try:
-    from responsive import are_neurons_responsive
+    from responsive import are_neurons_responsive, _get_spikes_in_windows
+    from cache import get_cache_path, hash_inputs, save_to_cache
+    from complete_raster_depth_per_spike import get_depth_sorted_raster
+    from stim_info import load_stim_info
 except:
-    from v1_protocol.responsive import are_neurons_responsive
+    from v1_protocol.responsive import are_neurons_responsive, _get_spikes_in_windows
+    from v1_protocol.cache import get_cache_path, hash_inputs, save_to_cache
+    from v1_protocol.complete_raster_depth_per_spike import get_depth_sorted_raster
+    from v1_protocol.stim_info import load_stim_info
 
 def bin_responses(spike_times, spike_clusters, stim_times, stim_values, output_fr=True):
     """
@@ -27,36 +33,129 @@ def bin_responses(spike_times, spike_clusters, stim_times, stim_values, output_f
     :return: number of spikes for each clusterduring stimulus presentation
     :rtype: array of shape `(n_clusters, n_stims, n_stim_reps)`
     """
-    cluster_ids = np.unique(spike_clusters)
+    spike_times = np.asarray(spike_times)
+    stim_times = np.asarray(stim_times)
+    stim_values = np.asarray(stim_values)
+    cluster_ids, cluster_idxs = np.unique(spike_clusters, return_inverse=True)
     n_clusters = len(cluster_ids)
-    stim_ids = np.unique(stim_values)
+    stim_ids, stim_idxs = np.unique(stim_values, return_inverse=True)
     n_stims = len(stim_ids)
     n_reps = len(np.where(stim_values == stim_values[0])[0])
+    n_pres = len(stim_values)
+    # repetition number of each presentation, counted in order of presentation
+    pres_per_stim = np.bincount(stim_idxs, minlength=n_stims)
+    i_sort = np.argsort(stim_idxs, kind='stable')
+    rep_idxs = np.empty(n_pres, dtype=np.int64)
+    rep_idxs[i_sort] = np.arange(n_pres) - np.repeat(
+        np.cumsum(pres_per_stim) - pres_per_stim, pres_per_stim)
+    # find spikes in (onset, offset] of every presentation in one pass over the sorted spikes
+    if np.any(np.diff(spike_times) < 0):
+        i_sort = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[i_sort]
+        cluster_idxs = cluster_idxs[i_sort]
+    pres_idxs, spike_idxs = _get_spikes_in_windows(
+        spike_times, stim_times[:, 0], stim_times[:, 1], closed='right')
+    # bin spikes similar to bincount2D with a single bin per presentation
+    bin_sizes = np.diff(stim_times, axis=1)[:, 0]
+    xind = np.floor((spike_times[spike_idxs] - stim_times[pres_idxs, 0]) / bin_sizes[pres_idxs])
+    pres_idxs = pres_idxs[xind == 0]
+    spike_idxs = spike_idxs[xind == 0]
+    counts = np.bincount(
+        cluster_idxs[spike_idxs] * n_pres + pres_idxs, minlength=n_clusters * n_pres)
+    counts = counts.reshape((n_clusters, n_pres))
+    # store
+    scale = bin_sizes if output_fr else np.ones(n_pres)
     responses = np.zeros(shape=(n_clusters, n_stims, n_reps))
-    stim_reps = np.zeros(shape=n_stims, dtype=np.int)
-    for stim_time, stim_val in zip(stim_times, stim_values):
-        i_stim = np.where(stim_ids == stim_val)[0][0]
-        i_rep = stim_reps[i_stim]
-        stim_reps[i_stim] += 1
-        # filter spikes
-        idxs = (spike_times > stim_time[0]) & (spike_times <= stim_time[1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        bin_size = np.diff(stim_time)[0]
-        xscale = stim_time
-        xind = (np.floor((i_spikes - stim_time[0]) / bin_size)).astype(np.int64)
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-        # store
-        bs_idxs = np.isin(cluster_ids, yscale)
-        scale = bin_size if output_fr else 1.0
-        responses[bs_idxs, i_stim, i_rep] = r[:, 0] / scale
+    responses[:, stim_idxs, rep_idxs] = counts / scale
     return responses
 
 
+def calculate_peth_means(
+        spike_times, spike_clusters, cluster_ids, align_times, stim_values, pre_time=0.2,
+        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True):
+    """
+    Compute the mean peri-event time histogram of each cluster for each stimulus in a single pass
+    over the spikes; binning and smoothing are the same as in
+    `brainbox.singlecell.calculate_peths`, which would otherwise be called once per stimulus.
+    Since smoothing is linear, trial-averaged spike counts are smoothed instead of single trials.
+
+    :param spike_times: array of spike times
+    :type spike_times: array-like
+    :param spike_clusters: array of cluster ids associated with each entry in `spike_times`
+    :type spike_clusters: array-like
+    :param cluster_ids: clusters for which to compute peths
+    :type cluster_ids: array-like
+    :param align_times: times (sec) of all stimulus presentations
+    :type align_times: array-like
+    :param stim_values: stimulus id of each entry in `align_times`
+    :type stim_values: array-like
+    :param pre_time: time (sec) to precede align times in peth
+    :type pre_time: float
+    :param post_time: time (sec) to follow align times in peth
+    :type post_time: float
+    :param bin_size: width of time windows (sec) used to bin spikes
+    :type bin_size: float
+    :param smoothing: standard deviation (sec) of gaussian kernel for smoothing peths; use
+        `smoothing=0` to skip smoothing
+    :type smoothing: float
+    :param return_fr: True to return firing rates, False to return spike counts
+    :type return_fr: bool
+    :return: peth means of shape `(n_stims, n_clusters, n_bins)`; stimuli and clusters are sorted
+        by increasing id
+    :rtype: np.ndarray
+    """
+    from scipy.signal import convolve
+    from scipy.signal.windows import gaussian
+
+    n_offset = 5 * int(np.ceil(smoothing / bin_size))  # get rid of boundary effects for smoothing
+    n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
+    n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
+    n_bins = n_bins_pre + n_bins_post
+    tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+
+    ids = np.unique(cluster_ids)
+    stim_ids, stim_idxs = np.unique(stim_values, return_inverse=True)
+    n_trials = np.bincount(stim_idxs, minlength=len(stim_ids))
+    align_times = np.asarray(align_times)
+
+    # restrict spikes to requested clusters
+    spike_times = np.asarray(spike_times)
+    spike_clusters = np.asarray(spike_clusters)
+    mask = np.isin(spike_clusters, ids)
+    spike_times = spike_times[mask]
+    cluster_idxs = np.searchsorted(ids, spike_clusters[mask])
+    if np.any(np.diff(spike_times) < 0):
+        i_sort = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[i_sort]
+        cluster_idxs = cluster_idxs[i_sort]
+
+    # bin spikes of all trials at once; bins are edges of `tscale`, and as in `calculate_peths`
+    # spikes on the last edge fall into an extra bin that is only used for smoothing
+    t_beg = align_times + tscale[0]
+    t_end = align_times + tscale[-1]
+    trial_idxs, spike_idxs = _get_spikes_in_windows(spike_times, t_beg, t_end, closed='both')
+    xind = np.floor((spike_times[spike_idxs] - t_beg[trial_idxs]) / bin_size).astype(np.int64)
+    counts = np.bincount(
+        (stim_idxs[trial_idxs] * len(ids) + cluster_idxs[spike_idxs]) * (n_bins + 1) + xind,
+        minlength=len(stim_ids) * len(ids) * (n_bins + 1))
+    counts = counts.reshape((len(stim_ids), len(ids), n_bins + 1))
+    peth_means = counts / n_trials[:, None, None]
+
+    # smooth
+    if smoothing > 0:
+        w = n_bins - 1 if n_bins % 2 == 0 else n_bins
+        window = gaussian(w, std=smoothing / bin_size)
+        window /= np.sum(window)
+        peth_means = convolve(peth_means, window[None, None, :], mode='same')
+    # ts represent bin edges, so there is one fewer bin
+    peth_means = peth_means[:, :, :-1]
+    if return_fr:
+        peth_means = peth_means / bin_size
+    if smoothing > 0:
+        peth_means = peth_means[:, :, n_offset:-n_offset]
+    return peth_means
+
+
 def compute_selectivity(means, thetas, measure):
     """
     Compute direction or orientation selectivity index measure, as well as preferred direction/ori
@@ -64,7 +163,8 @@ def compute_selectivity(means, thetas, measure):
     https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4123790/
 
     :param means: mean responses over multiple stimulus presentations; array of shape
-        `(n_clusters, n_stims)`
+        `(n_clusters, n_stims)` (any number of leading dimensions is accepted; indices are computed
+        along the last one)
     :type means: array-like
     :param thetas: grating direction in radians (corresponds to dimension 1 of `means`)
     :type thetas: array-like
@@ -78,13 +178,96 @@ def compute_selectivity(means, thetas, measure):
         factor = 2
     else:
         raise ValueError('"%s" is an invalid measure; must be "dir" or "ori"' % measure)
-    vector_norm = means / np.sum(means, axis=1, keepdims=True)
-    vector_sum = np.sum(vector_norm * np.exp(factor * 1.j * thetas), axis=1)
+    vector_norm = means / np.sum(means, axis=-1, keepdims=True)
+    vector_sum = np.sum(vector_norm * np.exp(factor * 1.j * thetas), axis=-1)
     index = np.abs(vector_sum)
     preference = np.angle(vector_sum) / factor
     return index, preference
 
 
+def compute_selectivity_stats(
+        responses, thetas, measure, method='bootstrap', n_samples=1000, alpha=0.05, rng=None,
+        batch_size=100):
+    """
+    Compute direction or orientation selectivity indices of all clusters together with their
+    bootstrap confidence intervals or permutation p values; resampled trial means of all clusters
+    are computed at once as a product of the response tensor with resampling matrices that are
+    shared by all clusters
+
+    :param responses: responses to each stimulus presentation (output of `bin_responses`); array of
+        shape `(n_clusters, n_stims, n_reps)`
+    :type responses: array-like
+    :param thetas: grating direction in radians (corresponds to dimension 1 of `responses`)
+    :type thetas: array-like
+    :param measure: 'ori' | 'dir' - compute orientation or direction selectivity
+    :type measure: str
+    :param method: 'bootstrap' - resample presentations of each stimulus with replacement;
+        'permutation' - shuffle stimulus labels across all presentations (null hypothesis of no
+        tuning)
+    :type method: str
+    :param n_samples: number of bootstrap samples or permutations
+    :type n_samples: int
+    :param alpha: the confidence intervals cover the central `1 - alpha` of the resampled indices
+    :type alpha: float
+    :param rng: None, an int seed or a `numpy.random.Generator`
+    :param batch_size: number of samples computed at once; bounds memory usage to
+        `batch_size * n_clusters * n_stims` values
+    :type batch_size: int
+    :return: dict with keys
+        - 'index', 'preference': output of `compute_selectivity` for the trial-averaged responses;
+          arrays of shape `(n_clusters,)`
+        - 'ci': array of shape `(n_clusters, 2)`; for 'bootstrap' the confidence interval of the
+          index, for 'permutation' the interval of the index under the null hypothesis
+        - 'p_value': for 'permutation', the fraction of permutations with an index at least as
+          large as the observed one (with the observed labelling counted as a permutation); None
+          for 'bootstrap'
+        'ci' and 'p_value' are NaN for clusters whose index is undefined (no response to any
+        stimulus)
+    """
+    responses = np.asarray(responses, dtype='float')
+    _, n_stims, n_reps = responses.shape
+    if method not in ('bootstrap', 'permutation'):
+        raise ValueError(
+            '"%s" is an invalid method; must be "bootstrap" or "permutation"' % method)
+    rng = np.random.default_rng(rng)
+    with np.errstate(invalid='ignore'):  # undefined indices are handled below
+        index, preference = compute_selectivity(np.mean(responses, axis=2), thetas, measure)
+
+    indices = np.zeros(shape=(n_samples, len(index)))
+    for b0 in range(0, n_samples, batch_size):
+        n_batch = min(batch_size, n_samples - b0)
+        if method == 'bootstrap':
+            # number of times each presentation is drawn; shape (n_batch, n_stims, n_reps)
+            multiplicity = rng.multinomial(
+                n_reps, np.full(n_reps, 1 / n_reps), size=(n_batch, n_stims))
+            means = np.einsum(
+                'bsr,csr->bcs', multiplicity, responses, optimize=True) / n_reps
+        else:
+            # stimulus assigned to each presentation; shape (n_batch, n_stims * n_reps, n_stims)
+            labels = rng.permuted(
+                np.tile(np.repeat(np.arange(n_stims), n_reps), (n_batch, 1)), axis=1)
+            one_hot = np.eye(n_stims)[labels]
+            means = np.einsum(
+                'bts,ct->bcs', one_hot, responses.reshape(-1, n_stims * n_reps),
+                optimize=True) / n_reps
+        with np.errstate(invalid='ignore'):
+            indices[b0:b0 + n_batch], _ = compute_selectivity(means, thetas, measure)
+
+    # the index is undefined (NaN) for clusters without spikes, and for resamples in which all
+    # mean responses are 0; the latter are left out of the interval
+    undefined = np.isnan(index)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN columns
+        ci = np.nanpercentile(
+            indices, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0).T
+    ci[undefined] = np.nan
+    p_value = None
+    if method == 'permutation':
+        p_value = (1 + np.sum(indices >= index, axis=0)) / (1 + n_samples)
+        p_value[undefined] = np.nan
+    return {'index': index, 'preference': preference, 'ci': ci, 'p_value': p_value}
+
+
 def scatterplot(xs, ys, xlabel, ylabel, id_line=False, linewidth=1, ax=None):
     """
     General scatterplot function
@@ -152,16 +335,63 @@ def plot_cdfs(prefs, xlabel, ax=None):
         return ax
 
 
-def plot_value_by_depth(values, depths, xlabel, ylabel, window=25, linewidth=1, ax=None):
+def bin_values_by_depth(values, depths, bin_width=100, depth_range=None):
+    """
+    Average one or more metrics over clusters in bins of depth
+
+    :param values: metric value of each cluster; NaN values are ignored
+    :type values: array of shape `(n_clusters,)` or `(n_metrics, n_clusters)`
+    :param depths: depth of each cluster
+    :type depths: array-like of shape `(n_clusters,)`
+    :param bin_width: width of the depth bins, in the units of `depths`
+    :type bin_width: float
+    :param depth_range: (min, max) depths covered by the bins; if `None`, the range of `depths`
+    :type depth_range: tuple or NoneType
+    :return: depth of the bin centers, mean and standard error of the mean of each metric in
+        each bin (the mean is NaN for bins without clusters, the standard error for bins with
+        fewer than 2 clusters)
+    :rtype: tuple of arrays of shape `(n_bins,)`, `values.shape[:-1] + (n_bins,)` and
+        `values.shape[:-1] + (n_bins,)`
+    """
+    values = np.asarray(values, dtype=float)
+    depths = np.asarray(depths, dtype=float)
+    # clusters without a depth are left out
+    lo, hi = (np.nanmin(depths), np.nanmax(depths)) if depth_range is None else depth_range
+    n_bins = max(int(np.ceil((hi - lo) / bin_width)), 1)
+    bin_centers = lo + bin_width * (np.arange(n_bins) + 0.5)
+    with np.errstate(invalid='ignore'):
+        bin_idxs = np.clip(np.floor((depths - lo) / bin_width), 0, n_bins - 1)
+    bin_idxs = np.nan_to_num(bin_idxs).astype(int)
+    # a single bincount over all metrics: one group of `n_bins` bins per metric
+    flat_values = values.reshape((-1, values.shape[-1]))
+    n_metrics = flat_values.shape[0]
+    valid = ~np.isnan(flat_values) & (depths >= lo) & (depths <= hi)
+    idxs = (np.arange(n_metrics)[:, None] * n_bins + bin_idxs)[valid]
+    x = flat_values[valid]
+    n = np.bincount(idxs, minlength=n_metrics * n_bins)
+    sums = np.bincount(idxs, weights=x, minlength=n_metrics * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / n
+        sq_devs = np.bincount(
+            idxs, weights=(x - means[idxs]) ** 2, minlength=n_metrics * n_bins)
+        # standard error from the sample standard deviation; undefined with fewer than 2 clusters
+        sems = np.sqrt(sq_devs / (n - 1)) / np.sqrt(n)
+    sems[n < 2] = np.nan
+    shape = values.shape[:-1] + (n_bins,)
+    return bin_centers, means.reshape(shape), sems.reshape(shape)
+
+
+def plot_value_by_depth(
+        values, depths, xlabel, ylabel, bin_width=100, linewidth=1, ax=None):
     """
-    Plot a given value by depth along with a line indicating the running average of the value if
-    `window` is greater than 0.
+    Plot a given value by depth along with a line indicating the mean of the value (and a band
+    indicating its standard error) in bins of depth if `bin_width` is greater than 0.
 
     :param values: array-like
     :param depths: array-like
     :param xlabel:
     :param ylabel:
-    :param window: window for running average
+    :param bin_width: width of the depth bins for the mean, in the units of `depths`
     :param linewidth:
     :param ax:
     :return:
@@ -171,20 +401,14 @@ def plot_value_by_depth(values, depths, xlabel, ylabel, window=25, linewidth=1,
         fig, ax = plt.subplots(1, 1, figsize=(4, 6))
         return_fig = True
 
-    if window > 0:
-        x = np.linspace(np.min(depths), np.max(depths), 100)
-        f = np.interp(x, xp=depths[~np.isnan(values)], fp=values[~np.isnan(values)])
-        running_average = np.convolve(f, np.ones(window) / window, mode='same')
-    else:
-        x = None
-        running_average = None
-
     ax.scatter(values, depths, marker='.', c=[[0.1, 0.1, 0.1]], s=5)
     # plot center line at 1
     ax.axvline(x=1, ymin=0.02, ymax=0.98, color=[0.7, 0.7, 0.7], linewidth=linewidth)
-    # plot running average
-    if window > 0:
-        ax.plot(running_average, x, 'r', linewidth=linewidth)
+    # plot binned average
+    if bin_width > 0:
+        x, mean, sem = bin_values_by_depth(values, depths, bin_width=bin_width)
+        ax.fill_betweenx(x, mean - sem, mean + sem, color='r', alpha=0.2, linewidth=0)
+        ax.plot(mean, x, 'r', linewidth=linewidth)
     ax.set_xscale('log')
     ax.set_xlabel(xlabel)
     ax.invert_yaxis()
@@ -399,7 +623,7 @@ def plot_polar_psth_and_rasters(
 def plot_grating_figures(
     session_path, cluster_ids_summary, cluster_ids_selected, save_dir=None, format='png',
         pre_time=0.5, post_time=2.5, bin_size=0.005, smoothing=0.025, n_rand_clusters=20,
-        plot_summary=True, plot_selected=True):
+        plot_summary=True, plot_selected=True, seed=None, n_osi_permutations=1000, alpha=0.05):
     """
     Produces two summary figures for the oriented grating protocol; the first summary figure
     contains plots that compare different measures during the first and second grating protocols,
@@ -437,11 +661,23 @@ def plot_grating_figures(
         a flag for plotting the summary figure
     plot_selected : bool
         a flag for plotting the selected units figure
+    seed : int or NoneType
+        seed for subsampling spontaneous activity in the responsiveness test, for choosing
+        random clusters and for the osi permutation tests; if NoneType, the global random state is
+        used
+    n_osi_permutations : int
+        the number of permutations of the stimulus labels used to compute the osi p values; if 0,
+        no p values are computed
+    alpha : float
+        the p value below which an osi is considered significant in the summary figure
         
     Returns
     -------
     metrics : dict
         - 'osi' (dict): keys 'beg', 'end' point to arrays of osis during these epochs
+        - 'osi_p_value' (dict): keys 'beg', 'end' point to arrays of permutation p values of the
+          osis during these epochs (see `compute_selectivity_stats`); only if
+          `n_osi_permutations > 0`
         - 'orientation_pref' (dict): keys 'beg', 'end' point to arrays of orientation preference
         - 'frac_resp_by_depth' (dict): fraction of responsive clusters by depth
     
@@ -450,6 +686,7 @@ def plot_grating_figures(
     """
 
     fig_dict = {}
+    rng = None if seed is None else np.random.default_rng(seed)
     cluster_ids = cluster_ids_summary
     cluster_idxs = cluster_ids_selected
     epochs = ['beg', 'end']
@@ -460,17 +697,10 @@ def plot_grating_figures(
     print('loading alf objects...', end='', flush=True)
     spikes = ioalf.load_object(session_path, 'spikes')
     clusters = ioalf.load_object(session_path, 'clusters')
-    gratings = ioalf.load_object(session_path, '_iblcertif_.odsgratings')
-    spontaneous = ioalf.load_object(session_path, '_iblcertif_.spontaneous')
-    grating_times = {
-        'beg': gratings['odsgratings.times.00'],
-        'end': gratings['odsgratings.times.01']}
-    grating_vals = {
-        'beg': gratings['odsgratings.stims.00'],
-        'end': gratings['odsgratings.stims.01']}
-    spont_times = {
-        'beg': spontaneous['spontaneous.times.00'],
-        'end': spontaneous['spontaneous.times.01']}
+    stim_info = load_stim_info(session_path)
+    grating_times = stim_info['grating_times']
+    grating_vals = stim_info['grating_vals']
+    spont_times = stim_info['spont_times']
 
     # --------------------------
     # calculate relevant metrics
@@ -480,13 +710,13 @@ def plot_grating_figures(
     mask_clust = np.isin(spikes.clusters, cluster_ids)  # update mask for responsive clusters
     mask_times = np.full(spikes.times.shape, fill_value=False)
     for epoch in epochs:
-        mask_times |= (spikes.times >= grating_times[epoch].min()) & \
-                      (spikes.times <= grating_times[epoch].max())
+        t_beg, t_end = stim_info['grating_epochs'][epoch]
+        mask_times |= (spikes.times >= t_beg) & (spikes.times <= t_end)
     resp = {epoch: [] for epoch in epochs}
     for epoch in epochs:
         resp[epoch] = are_neurons_responsive(
             spikes.times[mask_clust], spikes.clusters[mask_clust], grating_times[epoch],
-            grating_vals[epoch], spont_times[epoch])
+            grating_vals[epoch], spont_times[epoch], rng=rng)
     responses = {epoch: [] for epoch in epochs}
     for epoch in epochs:
         responses[epoch] = bin_responses(
@@ -506,6 +736,19 @@ def plot_grating_figures(
             responses_mean[epoch], np.unique(grating_vals[epoch]), 'ori')
     print('done')
 
+    # test the significance of the osis of all clusters at once
+    osi_p_value = None
+    if n_osi_permutations > 0:
+        print('calcuating osi significance...', end='', flush=True)
+        # separate generator, so that the random clusters do not depend on `n_osi_permutations`
+        rng_osi = None if seed is None else np.random.default_rng(seed)
+        osi_p_value = {
+            epoch: compute_selectivity_stats(
+                responses[epoch], np.unique(grating_vals[epoch]), 'ori', method='permutation',
+                n_samples=n_osi_permutations, rng=rng_osi)['p_value']
+            for epoch in epochs}
+        print('done')
+
     # calculate depth vs osi ratio (osi_beg/osi_end)
     print('calcuating osi ratio as a function of depth...', end='', flush=True)
     depths = np.array([clusters.depths[c] for c in cluster_ids])
@@ -541,22 +784,14 @@ def plot_grating_figures(
 
     # calculate PSTH averaged over all clusters/orientations
     print('calcuating average PSTH...', end='', flush=True)
-    peths = {epoch: [] for epoch in epochs}
     peths_avg = {epoch: [] for epoch in epochs}
     for epoch in epochs:
-        stim_ids = np.unique(grating_vals[epoch])
-        peths[epoch] = {i: None for i in range(len(stim_ids))}
-        peths_avg_tmp = []
-        for i, stim_id in enumerate(stim_ids):
-            curr_stim_idxs = np.where(grating_vals[epoch] == stim_id)
-            align_times = grating_times[epoch][curr_stim_idxs, 0][0]
-            peths[epoch][i], _ = calculate_peths(
-                spikes.times[mask_times], spikes.clusters[mask_times], cluster_ids,
-                align_times, pre_time=pre_time, post_time=post_time, bin_size=bin_size,
-                smoothing=smoothing, return_fr=True)
-            peths_avg_tmp.append(
-                np.mean(peths[epoch][i]['means'], axis=0, keepdims=True))
-        peths_avg_tmp = np.vstack(peths_avg_tmp)
+        # peths of all stimuli at once; shape (n_stims, n_clusters, n_bins)
+        peth_means = calculate_peth_means(
+            spikes.times[mask_times], spikes.clusters[mask_times], cluster_ids,
+            grating_times[epoch][:, 0], grating_vals[epoch], pre_time=pre_time,
+            post_time=post_time, bin_size=bin_size, smoothing=smoothing, return_fr=True)
+        peths_avg_tmp = np.mean(peth_means, axis=1)
         peths_avg[epoch] = {
             'mean': np.mean(peths_avg_tmp, axis=0),
             'std': np.std(peths_avg_tmp, axis=0) / np.sqrt(peths_avg_tmp.shape[0])}
@@ -577,13 +812,10 @@ def plot_grating_figures(
             n_stims = len(np.unique(grating_vals[epoch]))
             mask_idxs_e = (spikes.times >= grating_times[epoch][:n_stims].min()) & \
                           (spikes.times <= grating_times[epoch][:n_stims].max())
-            r_tmp, r_times[epoch], r_clusters[epoch] = bincount2D(
-                spikes.times[mask_idxs_e], spikes.clusters[mask_idxs_e], bin_size)
             # order activity by anatomical depth of neurons
-            d = dict(zip(spikes.clusters[mask_idxs_e], spikes.depths[mask_idxs_e]))
-            y = sorted([[i, d[i]] for i in d])
-            isort = np.argsort([x[1] for x in y])
-            r[epoch] = r_tmp[isort, :]
+            r[epoch], r_times[epoch], r_clusters[epoch] = get_depth_sorted_raster(
+                spikes.times[mask_idxs_e], spikes.clusters[mask_idxs_e], clusters.depths,
+                bin_size)
         # package for plotting
         rasters = {'spikes': r, 'times': r_times, 'clusters': r_clusters, 'bin_size': bin_size}
         print('done')
@@ -595,7 +827,8 @@ def plot_grating_figures(
         print('computing psths and rasters for clusters...', end='', flush=True)
         if len(cluster_ids_selected) == 0:
             if (n_rand_clusters < len(cluster_ids)):
-                cluster_idxs = np.random.choice(cluster_ids, size=n_rand_clusters, replace=False)
+                choice = np.random.choice if rng is None else rng.choice
+                cluster_idxs = choice(cluster_ids, size=n_rand_clusters, replace=False)
             else:
                 cluster_idxs = cluster_ids
         else:
@@ -608,14 +841,17 @@ def plot_grating_figures(
             for epoch in epochs:
                 mean_responses[cluster_idx][epoch] = responses_mean[epoch][cluster, :][0]
                 osis[cluster_idx][epoch] = osi[epoch][cluster]
-                stim_ids = np.unique(grating_vals[epoch])
-                binned[cluster_idx][epoch] = {j: None for j in range(len(stim_ids))}
-                for j, stim_id in enumerate(stim_ids):
-                    curr_stim_idxs = np.where(grating_vals[epoch] == stim_id)
-                    align_times = grating_times[epoch][curr_stim_idxs, 0][0]
-                    _, binned[cluster_idx][epoch][j] = calculate_peths(
-                        spikes.times[mask_times], spikes.clusters[mask_times], [cluster_idx],
-                        align_times, pre_time=pre_time, post_time=post_time, bin_size=bin_size)
+        for epoch in epochs:
+            # bin all presentations for all selected clusters at once (trials are binned
+            # independently), then split by cluster and stimulus
+            _, binned_all = calculate_peths(
+                spikes.times[mask_times], spikes.clusters[mask_times], cluster_idxs,
+                grating_times[epoch][:, 0], pre_time=pre_time, post_time=post_time,
+                bin_size=bin_size)
+            stim_ids, stim_idxs = np.unique(grating_vals[epoch], return_inverse=True)
+            for i, cluster_idx in enumerate(np.unique(cluster_idxs)):
+                binned[cluster_idx][epoch] = {
+                    j: binned_all[stim_idxs == j][:, [i], :] for j in range(len(stim_ids))}
         print('done')
 
     # --------------
@@ -631,7 +867,8 @@ def plot_grating_figures(
             save_file = os.path.join(save_dir, 'grating_summary_figure.' + format)
         fig_gr_summary = plot_summary_figure(
             ratios=ratios, depths=depths, responsive=responsive, peths_avg=peths_avg, osi=osi,
-            ori_pref=ori_pref, responses_mean=responses_mean, rasters=rasters, save_file=save_file)
+            ori_pref=ori_pref, responses_mean=responses_mean, rasters=rasters, save_file=save_file,
+            osi_p_value=osi_p_value, alpha=alpha)
         fig_gr_summary.suptitle('Summary Grating Responses')
         fig_dict['gr_summary'] = fig_gr_summary
 
@@ -655,11 +892,13 @@ def plot_grating_figures(
         'orientation_pref': ori_pref,
         'frac_resp_by_depth': responsive,
     }
+    if osi_p_value is not None:
+        metrics['osi_p_value'] = osi_p_value
     return fig_dict, metrics
 
 def plot_summary_figure(
         depths, ratios, responsive, peths_avg, osi, ori_pref, responses_mean, rasters,
-        save_file=None):
+        save_file=None, osi_p_value=None, alpha=0.05):
     """
     Produce summary figure for responses to orientated gratings. See code in calling function
     `plot_grating_figures` to see how these inputs are created.
@@ -673,6 +912,9 @@ def plot_summary_figure(
     :param responses_mean:
     :param rasters:
     :param save_file:
+    :param osi_p_value: dict with keys `beg` and `end`, each of which is an array of osi p values;
+        if not None, clusters with a significant osi in both epochs are highlighted
+    :param alpha: significance level of the osi p values
     :return fig:
     """
 
@@ -697,7 +939,7 @@ def plot_summary_figure(
     # osi ratio as a function of depth
     ax = fig.add_subplot(gs1a[0])
     ax = plot_value_by_depth(
-        ratios, depths, xlabel='OSI ratio (beg/end)', ylabel='Depth (mm)', window=25,
+        ratios, depths, xlabel='OSI ratio (beg/end)', ylabel='Depth (mm)', bin_width=100,
         linewidth=2, ax=ax)
 
     # fraction of visual clusters by depth
@@ -726,6 +968,13 @@ def plot_summary_figure(
     ax = scatterplot(
         osi['beg'], osi['end'], 'OSI (beg epoch)', 'OSI (end epoch)', id_line=True,
         linewidth=2, ax=ax)
+    if osi_p_value is not None:
+        with np.errstate(invalid='ignore'):  # NaN p values are not significant
+            sig = (osi_p_value['beg'] < alpha) & (osi_p_value['end'] < alpha)
+        ax.scatter(
+            osi['beg'][sig], osi['end'][sig], marker='.', s=150, edgecolors=[1, 1, 1], alpha=1.0,
+            color='r', label='p < %g (%i/%i)' % (alpha, np.sum(sig), len(sig)))
+        ax.legend(loc='upper left', frameon=False)
 
     # ori pref end vs beg
     ax = fig.add_subplot(gs1b[1])
@@ -750,7 +999,8 @@ def plot_summary_figure(
         ax.imshow(
             rasters['spikes'][epoch], aspect='auto', cmap='binary',
             vmax=rasters['bin_size'] / 0.001 / 4, origin='upper',
-            extent=np.r_[rasters['times'][epoch][[0, -1]], rasters['clusters'][epoch][[0, -1]]])
+            extent=np.r_[rasters['times'][epoch][[0, -1]],
+                         np.min(rasters['clusters'][epoch]), np.max(rasters['clusters'][epoch])])
         ax.set_title('%s epoch\nFirst trial sequence' % epoch.capitalize())
         ax.set_xlabel('Time (s)')
         if ax.is_first_col():
@@ -812,7 +1062,13 @@ def plot_psths_and_rasters(
     return fig
 
 
-def get_vr_clusters(session_path, clusters=None, n_selected_cl=4):
+# part of the key of cached visually responsive clusters; increment it whenever a change of
+# `get_vr_clusters` or `are_neurons_responsive` changes their output
+VR_CLUSTERS_CACHE_VERSION = 1
+
+
+def get_vr_clusters(
+        session_path, clusters=None, n_selected_cl=4, seed=None, cache_dir=None, use_cache=True):
     '''
     Gets visually responsive clusters
     
@@ -825,6 +1081,15 @@ def get_vr_clusters(session_path, clusters=None, n_selected_cl=4):
         visually response subset from all clusters from recording session.)
     n_selected_cl : int
         The number of clusters to return in `vr_clusters_selected`
+    seed : int or NoneType
+        Seed for subsampling spontaneous activity in the responsiveness test and for choosing
+        `clusters_selected_vr`. (if `None`, the global random state is used and results vary
+        between calls.)
+    cache_dir : str or NoneType
+        The root directory of the cache. (if `None`, `cache.DEFAULT_CACHE_DIR` is used.)
+    use_cache : bool
+        Whether to reuse results cached by a previous call with the same spikes, stimuli,
+        `clusters`, `n_selected_cl` and `seed`; results are only cached if `seed` is not `None`.
     
     Returns
     -------
@@ -840,17 +1105,10 @@ def get_vr_clusters(session_path, clusters=None, n_selected_cl=4):
     # load required alf objects
     # -------------------------
     spikes = ioalf.load_object(session_path, 'spikes')
-    gratings = ioalf.load_object(session_path, '_iblcertif_.odsgratings')
-    spontaneous = ioalf.load_object(session_path, '_iblcertif_.spontaneous')
-    grating_times = {
-        'beg': gratings['odsgratings.times.00'],
-        'end': gratings['odsgratings.times.01']}
-    grating_vals = {
-        'beg': gratings['odsgratings.stims.00'],
-        'end': gratings['odsgratings.stims.01']}
-    spont_times = {
-        'beg': spontaneous['spontaneous.times.00'],
-        'end': spontaneous['spontaneous.times.01']}
+    stim_info = load_stim_info(session_path)
+    grating_times = stim_info['grating_times']
+    grating_vals = stim_info['grating_vals']
+    spont_times = stim_info['spont_times']
 
     # ---------------------------------
     # find visually responsive clusters
@@ -860,25 +1118,47 @@ def get_vr_clusters(session_path, clusters=None, n_selected_cl=4):
         # speed up downstream computations by restricting data to relevant time periods
         mask_times = np.full(spikes.times.shape, fill_value=False)
         for epoch in epochs:
-            mask_times |= (spikes.times >= grating_times[epoch].min()) & \
-                          (spikes.times <= grating_times[epoch].max())
+            t_beg, t_end = stim_info['grating_epochs'][epoch]
+            mask_times |= (spikes.times >= t_beg) & (spikes.times <= t_end)
         clusters = np.unique(spikes.clusters[mask_times])
 
+    # results are deterministic given a seed, so they can be reused across calls
+    use_cache = use_cache and seed is not None
+    if use_cache:
+        key = hash_inputs(
+            spikes.times, spikes.clusters, clusters, *grating_times.values(),
+            *grating_vals.values(), *spont_times.values(), n_selected_cl=n_selected_cl,
+            seed=seed, version=VR_CLUSTERS_CACHE_VERSION)
+        path = get_cache_path('vr_clusters', key, cache_dir=cache_dir)
+        if path.exists():
+            print('done')
+            return (np.load(os.path.join(path, 'clusters_vr.npy')),
+                    np.load(os.path.join(path, 'clusters_selected_vr.npy')))
+    rng = None if seed is None else np.random.default_rng(seed)
+
     # only calculate responsiveness for clusters that were active during gratings
     mask_clust = np.isin(spikes.clusters, clusters)
     resp = {epoch: [] for epoch in epochs}
     for epoch in epochs:
         resp[epoch] = are_neurons_responsive(
             spikes.times[mask_clust], spikes.clusters[mask_clust], grating_times[epoch],
-            grating_vals[epoch], spont_times[epoch])
+            grating_vals[epoch], spont_times[epoch], rng=rng)
     resp_agg = resp['beg'] & resp['end']
     # remove non-responsive clusters
     clusters_vr = clusters[resp_agg]
     print('done')
     if n_selected_cl < len(clusters_vr):
-        clusters_selected_vr = np.random.choice(clusters_vr, size=n_selected_cl, replace=False)
+        choice = np.random.choice if rng is None else rng.choice
+        clusters_selected_vr = choice(clusters_vr, size=n_selected_cl, replace=False)
     else:
         clusters_selected_vr = clusters_vr
+
+    if use_cache:
+        def _save(save_path):
+            os.makedirs(save_path, exist_ok=True)
+            np.save(os.path.join(save_path, 'clusters_vr.npy'), clusters_vr)
+            np.save(os.path.join(save_path, 'clusters_selected_vr.npy'), clusters_selected_vr)
+        save_to_cache(path, _save)
     return clusters_vr, clusters_selected_vr
 
 
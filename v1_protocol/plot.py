@@ -62,6 +62,7 @@ from pathlib import Path
 from warnings import warn
 import shutil
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 from oneibl.one import ONE
 import alf.io as aio
@@ -70,6 +71,8 @@ from ibllib.io import certification_protocol
 from v1_protocol import orientation
 from v1_protocol import complete_raster_depth_per_spike as raster_depth
 from v1_protocol import rf_mapping
+from v1_protocol.cache import get_cache_path, hash_inputs, save_to_cache
+from v1_protocol.timing import StageTimer
 
 
 def gen_figures(
@@ -81,15 +84,18 @@ def gen_figures(
     selected_metrics = ['isi_viol', 'spks_missed', 'cv_fr', 'drift_depth', 'drift_amp',
                         'pres_ratio'],
     filt_params={'min_amp': 50e-6, 'min_fr': 0.5, 'max_fpr': 0.1, 'rp': 0.002},
-    grating_response_params={'pre_t': 0.5, 'post_t': 2.5, 'bin_t': 0.005, 'sigma': 0.025},
+    grating_response_params={'pre_t': 0.5, 'post_t': 2.5, 'bin_t': 0.005, 'sigma': 0.025,
+                             'n_osi_perm': 1000, 'alpha': 0.05},
     summary_metrics_params={'bins': 'auto', 'rp': 0.002, 'spks_per_bin': 20, 'sigma': 4,
                             'n_ch': 10, 'fr_hist_win': 0.01, 'fr_ma_win': 0.5, 'n_cv_bins': 10,
                             'n_ch_probe': 385, 'pr_hist_win': 10},
     selected_metrics_params={'spks_per_bin': 20, 'sigma': 4, 'rp': 0.002, 'bins': 'auto',
                              'n_ch': 10, 'fr_hist_win': 0.01, 'fr_ma_win': 0.5, 'n_cv_bins': 10,
                              'n_ch_probe': 385, 'isi_win': 0.01, 'pr_hist_win': 10},
-    rf_params={'method': 'corr', 'binsize': 0.025, 'lags': 8, 'n_depths': 30, 'use_svd': False},
-    save_dir=None, fig_names={}):
+    rf_params={'method': 'corr', 'binsize': 0.025, 'lags': 8, 'n_depths': 30, 'use_svd': False,
+               'n_jobs': 1, 'chunk_size': 10000, 'cache_dir': None, 'use_cache': True},
+    save_dir=None, fig_names={}, seed=None, cache_dir=None, use_cache=True, one=None,
+    report_timing=False, force_extract_stim_info=False):
     '''
     Generates figures for the V1 certification protocol for a given eid, probe, and clusters from a
     recording session.
@@ -110,7 +116,10 @@ def gen_figures(
     n_selected_cl : int
         The max number of `cluster_ids_selected` to choose if `cluster_ids_selected == None`.
     extract_stim_info : bool (optional)
-        A flag for extracting stimulus info from the recording session into an alf directory.
+        A flag for extracting stimulus info from the recording session into an alf directory. The
+        extraction is skipped if the '_iblcertif_' files in the alf directory are complete and
+        more recent than all the raw data they are extracted from (unless
+        `force_extract_stim_info` is `True`).
     grating_response_summary : bool (optional)
         A flag for returning a figure with summary grating response plots for `cluster_ids_summary`
     grating_response_selected : bool (optional)
@@ -156,6 +165,11 @@ def gen_figures(
                 The bin width (in s) used to determine the number of spikes/bin.
             'sigma' : float
                 The width (in s) of the smoothing kernel used to determine the number of spikes/bin.
+            'n_osi_perm' : int
+                The number of permutations of the stimulus labels used to compute the p values of
+                the OSIs (no p values are computed if 0).
+            'alpha' : float
+                The p value below which an OSI is shown as significant in the summary figure.
     filt_params : dict (optional)
         Parameters used in the call to `brainbox.processing.filter_units` for filtering clusters:
             'min_amp' : float
@@ -214,6 +228,18 @@ def gen_figures(
             'use_svd' : bool
                 `True` plots 1st spatial SVD component of rf; `False` plots time lag with
                 peak response.
+            'n_jobs' : int
+                The number of threads used to compute receptive fields (-1 uses all cores).
+            'chunk_size' : int
+                The number of time bins of binned spikes held in memory at once by the 'corr'
+                method; bounds memory usage to `chunk_size * n_clusters` bins per thread (if
+                `None`, all bins are processed at once). Results do not depend on it.
+            'cache_dir' : string
+                The root directory of the receptive field cache (if `None`, `cache_dir` is
+                used).
+            'use_cache' : bool
+                `True` reuses receptive fields cached by previous calls with the same spikes,
+                stimulus, method, binsize and lags; `False` always recomputes them.
     save_dir : string (optional)
         The directory in which to save generated figures. (if `None`, figures will not be saved).
     fig_names : dict (optional)
@@ -222,6 +248,26 @@ def gen_figures(
             'um_selected' : The name for the selected units' metrics figure.
             'gr_summary' : The name for the summary grating response summary figure.
             'gr_selected' : The name for the selected units' grating response figure.
+    seed : int (optional)
+        Seed for the random selection of units and for the subsampling of spontaneous activity in
+        the visual responsiveness test. (if `None`, the global random state is used and the
+        visually responsive units are recomputed on every call; otherwise they are cached).
+    cache_dir : string (optional)
+        The root directory of the cache of the units bunch, of the visually responsive units and,
+        unless `rf_params['cache_dir']` is given, of the receptive fields. (if `None`, the
+        default `~/.v1_protocol/cache` is used).
+    use_cache : bool (optional)
+        `True` reuses the units bunch saved by a previous call for the same `eid`, `probe` and
+        spike sorting output, and the visually responsive units found by a previous call with the
+        same spikes, stimuli, units and `seed`; `False` always recomputes them.
+    one : ONE (optional)
+        The ONE client used to find and download the data. (if `None`, a new client is created)
+    report_timing : bool (optional)
+        A flag for reporting the wall time and peak memory of each stage of the computations (see
+        `timing.StageTimer`). The report is returned in `m['stage_timing']`, printed, and saved as
+        'stage_timing.csv' in `save_dir` (if `save_dir` is not `None`).
+    force_extract_stim_info : bool (optional)
+        A flag for re-extracting stimulus info even if up-to-date '_iblcertif_' files exist.
 
     Returns
     -------
@@ -233,6 +279,12 @@ def gen_figures(
                 Possible keys:
                     'beg'
                     'end'
+            'osi_p_value' : dict
+                The permutation p value of the OSI of units in
+                `cluster_sets['cluster_ids_summary_vr]'` at the beginning and end of session (if
+                `grating_response_params['n_osi_perm'] > 0`). Possible keys:
+                    'beg'
+                    'end'
             'orientation_pref' : dict
                 The orientation preference of units in `cluster_sets['cluster_ids_summary_vr]'` at
                 the begininng and end of session. Possible keys:
@@ -268,6 +320,14 @@ def gen_figures(
                 Cumulative drift amp value for each unit in `cluster_sets['cluster_ids_summary']`.
             'pres_ratio' : ndarray
                 The presence ratio for each unit in `cluster_sets['cluster_ids_summary']`. 
+            'unit_metrics' : DataFrame
+                The table of all the above per-unit metrics computed for the summary metrics
+                figure (see `compute_unit_metrics`), indexed by unit.
+            'stage_timing' : DataFrame
+                The wall time and peak memory of each stage (if `report_timing`).
+            'filter_metrics' : DataFrame
+                The metrics used to filter units (see `compute_filter_metrics`), if units were
+                filtered; pass it to `filter_units_from_table` to try other thresholds.
     cluster_sets : dict
         Contains the ids of different sets of clusters used to generate the different figures.
         Possible keys:
@@ -288,7 +348,7 @@ def gen_figures(
     ibllib.io.certification_protocol
     orientation
     complete_raster_depth_per_spike
-    rf_mapping_old
+    rf_mapping
     brainbox.metrics.metrics
     brainbox.plot.plot
     using_master_plotting_function
@@ -303,7 +363,8 @@ def gen_figures(
     params = {'min_amp': 50e-6, 'min_fr': 0.5, 'max_fpr': 0.1, 'rp': 0.002}
     params.update(filt_params)
     filt_params = params
-    params = {'pre_t': 0.5, 'post_t': 2.5, 'bin_t': 0.005, 'sigma': 0.025}
+    params = {'pre_t': 0.5, 'post_t': 2.5, 'bin_t': 0.005, 'sigma': 0.025, 'n_osi_perm': 1000,
+              'alpha': 0.05}
     params.update(grating_response_params)
     grating_response_params = params
     params = {'bins': 'auto', 'rp': 0.002, 'spks_per_bin': 20, 'sigma': 4, 'n_ch': 10,
@@ -316,19 +377,24 @@ def gen_figures(
               'isi_win': 0.01, 'pr_hist_win': 10}
     params.update(selected_metrics_params)
     selected_metrics_params = params
-    params = {'method': 'corr', 'binsize': 0.025, 'lags': 8, 'n_depths': 30, 'use_svd': False}
+    params = {'method': 'corr', 'binsize': 0.025, 'lags': 8, 'n_depths': 30, 'use_svd': False,
+              'n_jobs': 1, 'chunk_size': 10000, 'cache_dir': None, 'use_cache': True}
     params.update(rf_params)
     rf_params = params
+    if rf_params['cache_dir'] is None:  # a single `cache_dir` enables all caches
+        rf_params['cache_dir'] = cache_dir
 
     # Initialize outputs #
     # ------------------ #
     m = bb.core.Bunch()
     cluster_sets = {}
     fig_h = {}
+    timer = StageTimer(enabled=report_timing)
 
     # Get necessary data via ONE #
     # -------------------------- #
-    one = ONE()
+    timer.start('locate data')
+    one = ONE() if one is None else one
     # Get important local paths from `eid`.
     spikes_path = one.load(eid, dataset_types='spikes.amps', clobber=False, download_only=True)[0]
     alf_dir_part = np.where([part == 'alf' for part in Path(spikes_path).parts])[0][0]
@@ -358,6 +424,7 @@ def gen_figures(
             " metrics. The metrics which require the binary ephys file are {}."
             .format(require_ephys))
     if extract_stim_info:  # get stimulus info and save in `alf_path`
+        timer.start('extract stimulus info')
         # Ensure all files necessary for stim info extraction exist.
         required_dtypes = [
             'ephysData.raw.meta', '_spikeglx_sync.channels', '_spikeglx_sync.polarities',
@@ -369,12 +436,19 @@ def gen_figures(
             raise FileNotFoundError(
                 "At least one of the required dataset_types for extracting stimulus info is" 
                 "missing. The required dataset_types are {}".format(required_dtypes))
-        # Proceed with extraction.
-        certification_protocol.extract_stimulus_info_to_alf(session_path, save=True)
-        # Copy `'_iblcertif'` files over to `alf_probe_path`
+        # Proceed with extraction, unless its outputs are already up to date.
+        if force_extract_stim_info or not(stim_info_up_to_date(alf_path, required_paths)):
+            certification_protocol.extract_stimulus_info_to_alf(session_path, save=True)
+        else:
+            print("Up-to-date '_iblcertif_' files found in {}, skipping stimulus info"
+                  " extraction.".format(alf_path))
+        # Copy new or updated `'_iblcertif'` files over to `alf_probe_path`
         for i in os.listdir(alf_path):
             if i[:10] == '_iblcertif':
-                shutil.copy(os.path.join(alf_path, i), alf_probe_path)
+                src = os.path.join(alf_path, i)
+                dst = os.path.join(alf_probe_path, i)
+                if not(os.path.exists(dst)) or (os.path.getmtime(dst) < os.path.getmtime(src)):
+                    shutil.copy2(src, dst)
     # Check to see if stim info extraction files exist.
     certif_exists = False
     for i in os.listdir(alf_probe_path):
@@ -386,23 +460,35 @@ def gen_figures(
             "'_iblcertif_' extraction files not found. Either set 'grating_response_selected' and"
             " 'grating_response_summary' to False as as to not generate these figures, or set"
             " 'extract_stim_info' to True to extract the '_iblcertif_' files.")
-    # Get units bunch.
-    spks_b = aio.load_object(alf_probe_path, 'spikes')
-    print('Re-formatting alf data to save time during plotting. May take a few minutes...', 
-          flush=True, end='')
-    units_b = bb.processing.get_units_bunch(spks_b)
-    print('done')
+    # Clusters are filtered for any figure, so that each figure is made from the same clusters
+    # whichever other figures are requested; this only needs the spikes bunch.
+    any_figure = grating_response_summary or grating_response_selected or \
+        unit_metrics_summary or unit_metrics_selected
+    filter_clusters = (cluster_ids_summary is None) and any_figure
+    spks_b = None
+    if unit_metrics_summary or unit_metrics_selected or filter_clusters:
+        timer.start('load spikes')
+        spks_b = aio.load_object(alf_probe_path, 'spikes')
+    # Get units bunch (only needed for the unit metrics figures).
+    units_b = None
+    if unit_metrics_summary or unit_metrics_selected:
+        timer.start('load units bunch')
+        units_b = load_units_bunch(
+            spks_b, eid, probe, cache_dir=cache_dir, use_cache=use_cache)
 
     # Set `cluster_ids_summary` and `cluster_ids_selected` #
     # ---------------------------------------------------- #
     
     # Filter all clusters according to `filt_params`
-    if (cluster_ids_summary is None) and unit_metrics_summary:  
+    if filter_clusters:
         print("'cluster_ids_summary' left empty, selecting filtered units.")
+        timer.start('filter units')
         T = spks_b['times'][-1] - spks_b['times'][0]
-        cluster_ids_summary = bb.processing.filter_units(
-            units_b, T, min_amp=filt_params['min_amp'], min_fr=filt_params['min_fr'],
-            max_fpr=filt_params['max_fpr'], rp=filt_params['rp'])
+        filter_table = compute_filter_metrics_from_spikes(spks_b, T, rp=filt_params['rp'])
+        m['filter_metrics'] = filter_table
+        cluster_ids_summary = filter_units_from_table(
+            filter_table, min_amp=filt_params['min_amp'], min_fr=filt_params['min_fr'],
+            max_fpr=filt_params['max_fpr'])
         if cluster_ids_summary.size == 0:
             raise ValueError("'cluster_ids_summary' is empty! Check filtering parameters in\
                              'filt_params'.")
@@ -415,8 +501,8 @@ def gen_figures(
         if len(cluster_ids_summary) <= (n_selected_cl):  # select all of `cluster_ids_summary`
             cluster_ids_selected = cluster_ids_summary
         else:  # select up to 5 units from `cluster_ids_summary`
-            cluster_ids_selected = np.random.choice(cluster_ids_summary,
-                                                    size=n_selected_cl, replace=False)
+            choice = np.random.choice if seed is None else np.random.default_rng(seed).choice
+            cluster_ids_selected = choice(cluster_ids_summary, size=n_selected_cl, replace=False)
     cluster_sets['cluster_ids_summary'] = cluster_ids_summary
     cluster_sets['cluster_ids_selected'] = cluster_ids_selected
     fig_list_name = []  # print this list at end of function to show which figures were generated
@@ -426,12 +512,15 @@ def gen_figures(
     if grating_response_summary or grating_response_selected:
         print('Generating grating response figure(s)...', flush=True, end='')
         # Get visually responsive clusters as subset of `cluster_ids_summary`.
+        timer.start('visual responsiveness')
         cluster_ids_summary_vr, cluster_ids_selected_vr = \
             orientation.get_vr_clusters(alf_probe_path, clusters=cluster_ids_summary,
-                                        n_selected_cl=n_selected_cl)
+                                        n_selected_cl=n_selected_cl, seed=seed,
+                                        cache_dir=cache_dir, use_cache=use_cache)
         cluster_sets['cluster_ids_summary_vr'] = cluster_ids_summary_vr
         cluster_sets['cluster_ids_selected_vr'] = cluster_ids_selected_vr
         # Generate grating figure(s)
+        timer.start('grating response figures')
         grating_figs, grating_metrics = orientation.plot_grating_figures(
             alf_probe_path, save_dir=None, pre_time=grating_response_params['pre_t'],
             post_time=grating_response_params['post_t'],
@@ -441,7 +530,10 @@ def gen_figures(
             cluster_ids_selected=cluster_ids_selected_vr,
             n_rand_clusters=n_selected_cl,
             plot_summary=grating_response_summary,
-            plot_selected=grating_response_selected)
+            plot_selected=grating_response_selected,
+            seed=seed,
+            n_osi_permutations=grating_response_params['n_osi_perm'],
+            alpha=grating_response_params['alpha'])
         fig_h.update(grating_figs) 
         m.update(grating_metrics)
         fig_list_name.extend(['grating_response_summary', 'grating_response_selected']) 
@@ -453,7 +545,7 @@ def gen_figures(
         print('Generating summary metrics figure...', flush=True, end='')
         fig_um_summary, m = um_summary_plots(
             cluster_ids_summary, summary_metrics, units_b, alf_probe_path, ephys_file_path, m,
-            summary_metrics_params, rf_params, certif_exists, save_dir=save_dir)
+            summary_metrics_params, rf_params, certif_exists, save_dir=save_dir, timer=timer)
         fig_h['um_summary'] = fig_um_summary
         fig_list_name.extend(['unit_metrics_summary'])
         print('done')
@@ -462,6 +554,7 @@ def gen_figures(
     # ------------------------------------- #
     if unit_metrics_selected:
         print('Generating selected units metrics figure...', flush=True, end='')
+        timer.start('selected metrics figure')
         fig_um_selected, m = um_selected_plots(
             cluster_ids_selected, selected_metrics, units_b, alf_probe_path, ephys_file_path, m,
             selected_metrics_params, save_dir=save_dir)
@@ -474,10 +567,11 @@ def gen_figures(
     # Save figures #
     # ------------ #
     if not(save_dir is None):  # if there is specified a directory to save to
+        timer.start('save figures')
         for name in fig_names:  # for each figure
             try:
                 # Create directory if doesn't already exist.
-                os.mkdir(save_dir) if not(os.path.exists(save_dir)) else []
+                os.makedirs(save_dir, exist_ok=True)
                 # Save figure.
                 fig_h[name].savefig(os.path.join(save_dir, fig_names[name] + '.png'))
             except Exception as err:
@@ -486,11 +580,229 @@ def gen_figures(
             else:
                 print('\nFigures saved in {}'.format(save_dir))
 
+    # Report timing #
+    # ------------- #
+    if report_timing:
+        timer.stop()
+        m['stage_timing'] = timer.report()
+        print('\nTime and peak memory per stage:\n{}'.format(m['stage_timing']))
+        if not(save_dir is None):
+            os.makedirs(save_dir, exist_ok=True)
+            timer.save(os.path.join(save_dir, 'stage_timing.csv'))
+
     return m, cluster_sets, fig_h
 
 
+CERTIF_OBJECTS = ['_iblcertif_.odsgratings', '_iblcertif_.spontaneous', '_iblcertif_.rfmap']
+
+
+def stim_info_up_to_date(alf_path, raw_paths):
+    '''
+    Checks whether the stimulus info extracted by
+    `certification_protocol.extract_stimulus_info_to_alf` can be reused: all the '_iblcertif_'
+    objects used by the figures (`CERTIF_OBJECTS`) exist in `alf_path`, and all the '_iblcertif_'
+    files were written after the last modification of the raw data they are extracted from.
+
+    Parameters
+    ----------
+    alf_path : string
+        The absolute path to the session's 'alf' directory.
+    raw_paths : list of strings
+        The paths to the raw data files used for the extraction.
+
+    Returns
+    -------
+    up_to_date : bool
+    '''
+
+    certif_files = [f for f in os.listdir(alf_path) if f[:10] == '_iblcertif']
+    if not all(any(f.startswith(obj + '.') for f in certif_files) for obj in CERTIF_OBJECTS):
+        return False
+    extracted_time = min(os.path.getmtime(os.path.join(alf_path, f)) for f in certif_files)
+    raw_time = max(os.path.getmtime(p) for p in raw_paths)
+    return extracted_time >= raw_time
+
+
+FIGURES = ['gr_summary', 'gr_selected', 'um_summary', 'um_selected']
+
+
+def gen_figures_batch(eids, probes, out_dir, figures=FIGURES, one=None, **kwargs):
+    '''
+    Generates a subset of the V1 certification figures for several recording sessions, without
+    displaying them, and saves them in `out_dir`. Only the computations needed for `figures` are
+    run. A failure for one session is reported and does not stop the others.
+
+    Parameters
+    ----------
+    eids : list of strings
+        The experiment IDs of the recording sessions.
+    probes : list of strings
+        The probe of each session in `eids`. (a single probe is used for all sessions)
+    out_dir : string
+        The directory in which to save the outputs; the outputs of each session and probe are
+        saved in '<out_dir>/<eid>/<probe>': one '<figure>.png' file per figure, and
+        'unit_metrics.csv' if 'um_summary' is in `figures`.
+    figures : list of strings (optional)
+        The figures to generate, amongst `FIGURES`:
+            'gr_summary' : The grating response summary figure.
+            'gr_selected' : The selected units' grating response figure.
+            'um_summary' : The summary metrics figure.
+            'um_selected' : The selected units' metrics figure.
+    one : ONE (optional)
+        The ONE client shared by all sessions. (if `None`, a new client is created)
+    **kwargs
+        Other input args for `gen_figures` (e.g. `filt_params`, `rf_params`, `seed`).
+
+    Returns
+    -------
+    outputs : dict
+        Keys are `(eid, probe)` tuples, values are the directory in which the outputs were saved,
+        or the exception raised while generating them.
+
+    See Also
+    --------
+    gen_figures
+    '''
+
+    unknown = set(figures) - set(FIGURES)
+    if unknown:
+        raise ValueError("Unknown figures {}; 'figures' must be amongst {}."
+                         .format(sorted(unknown), FIGURES))
+    if len(probes) == 1:
+        probes = list(probes) * len(eids)
+    if len(probes) != len(eids):
+        raise ValueError("'probes' must contain a single probe or one probe per eid.")
+    out_dir = os.path.expanduser(out_dir)
+    one = ONE() if one is None else one
+    flags = {
+        'grating_response_summary': 'gr_summary' in figures,
+        'grating_response_selected': 'gr_selected' in figures,
+        'unit_metrics_summary': 'um_summary' in figures,
+        'unit_metrics_selected': 'um_selected' in figures}
+    # stimulus info is only needed for the grating response figures and the summary rf maps
+    kwargs.setdefault('extract_stim_info', any(
+        flags[f] for f in ('grating_response_summary', 'grating_response_selected',
+                           'unit_metrics_summary')))
+
+    outputs = {}
+    backend = plt.get_backend()
+    plt.switch_backend('agg')  # never open windows or block on `plt.show`
+    try:
+        for eid, probe in zip(eids, probes):
+            save_dir = os.path.join(out_dir, str(eid), probe)
+            try:
+                os.makedirs(save_dir, exist_ok=True)
+                m, _, fig_h = gen_figures(
+                    eid, probe, save_dir=save_dir, fig_names={f: f for f in figures}, one=one,
+                    **flags, **kwargs)
+                if 'unit_metrics' in m:
+                    m['unit_metrics'].to_csv(os.path.join(save_dir, 'unit_metrics.csv'))
+                for fig in fig_h.values():
+                    plt.close(fig)
+                outputs[(eid, probe)] = save_dir
+            except Exception as err:
+                print("Failed to generate figures for eid {}, probe {}. Details: \n"
+                      .format(eid, probe))
+                print(err)
+                outputs[(eid, probe)] = err
+                plt.close('all')
+    finally:
+        plt.switch_backend(backend)
+    return outputs
+
+
+# part of the key of cached units bunches; increment it whenever the way they are computed or
+# saved changes
+UNITS_BUNCH_CACHE_VERSION = 1
+
+
+def load_units_bunch(spks_b, eid, probe, cache_dir=None, use_cache=True):
+    '''
+    Gets the units bunch (see `brainbox.processing.get_units_bunch`) of a probe, reusing the copy
+    saved by a previous call for the same spikes. The saved copy is found from a hash of the
+    contents of `spks_b`, so any change of the spike sorting output is detected, at the cost of
+    hashing all spike arrays on every call (which is much faster than recomputing the units
+    bunch).
+
+    Parameters
+    ----------
+    spks_b : bunch
+        A spikes bunch containing fields with spike information (e.g. cluster IDs, times, features,
+        etc.) for all spikes.
+    eid : string
+        The experiment ID for the recording session.
+    probe : string
+        The probe name.
+    cache_dir : string (optional)
+        The root directory of the cache. (if `None`, `cache.DEFAULT_CACHE_DIR` is used).
+    use_cache : bool (optional)
+        `False` always recomputes the units bunch (and does not save it).
+
+    Returns
+    -------
+    units_b : bunch
+        A bunch with a bunch for each spike feature, each containing the feature values of the
+        spikes of each unit (keyed by unit id as a string).
+    '''
+
+    feats = sorted(spks_b.keys())
+    key = hash_inputs(
+        *[spks_b[feat] for feat in feats], eid=eid, probe=probe, features=feats,
+        version=UNITS_BUNCH_CACHE_VERSION)
+    path = get_cache_path('units_bunch', key, cache_dir=cache_dir)
+    if use_cache and path.exists():
+        print('Loading units bunch from {}...'.format(path), flush=True, end='')
+        units_b = _read_units_bunch(path)
+        print('done')
+        return units_b
+    print('Re-formatting alf data to save time during plotting. May take a few minutes...',
+          flush=True, end='')
+    units_b = bb.processing.get_units_bunch(spks_b)
+    print('done')
+    if use_cache:
+        save_to_cache(path, lambda save_path: _write_units_bunch(units_b, save_path))
+    return units_b
+
+
+def _write_units_bunch(units_b, path):
+    '''
+    Saves a units bunch compactly: for each feature, the values of all units are concatenated in
+    a single 'feature.<feature>.npy' file, and 'offsets.npy' holds the start of each unit in
+    these arrays. A units bunch without features or units is saved as such.
+    '''
+
+    os.makedirs(path, exist_ok=True)
+    feats = list(units_b.keys())
+    units = list(units_b[feats[0]].keys()) if feats else []
+    lengths = [len(units_b[feats[0]][unit]) for unit in units]
+    np.save(os.path.join(path, 'features.npy'), np.array(feats, dtype=str))
+    np.save(os.path.join(path, 'units.npy'), np.array(units, dtype=str))
+    np.save(os.path.join(path, 'offsets.npy'), np.cumsum([0] + lengths))
+    for feat in feats:
+        values = [units_b[feat][unit] for unit in units]
+        np.save(os.path.join(path, 'feature.' + feat + '.npy'),
+                np.concatenate(values) if values else np.zeros(0))
+
+
+def _read_units_bunch(path):
+    '''
+    Loads a units bunch saved by `_write_units_bunch`; the values of each unit are views into the
+    concatenated feature arrays.
+    '''
+
+    units = np.load(os.path.join(path, 'units.npy'))
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    units_b = bb.core.Bunch()
+    for feat in np.load(os.path.join(path, 'features.npy')):
+        feat = str(feat)
+        values = np.load(os.path.join(path, 'feature.' + feat + '.npy'))
+        units_b[feat] = bb.core.Bunch(
+            (str(unit), values[offsets[i]:offsets[i + 1]]) for i, unit in enumerate(units))
+    return units_b
+
+
 def um_summary_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_path, m,
-                     metrics_params, rf_params, certif_exists, save_dir=None):
+                     metrics_params, rf_params, certif_exists, save_dir=None, timer=None):
     '''
     Computes/creates summary metrics and plots in a figure for all units in a recording session.
 
@@ -550,11 +862,19 @@ def um_summary_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_path
         'bin_sz' : the bin width (s) used
         'lags' : number of bins for calculating receptive field
         'method' : 'corr' or 'sta'
+        'n_jobs' : number of threads used to compute receptive fields (optional, default 1)
+        'chunk_size' : number of time bins held in memory at once by the 'corr' method (optional,
+            default `None`, i.e. all bins at once)
+        'cache_dir' : root directory of the receptive field cache (optional)
+        'use_cache' : whether to reuse cached receptive fields (optional, default `True`)
     certif_exists : bool
         A flag indicating whether the '_iblcertif_' files were found in `alf_probe_path`
     save_dir : string
         The path to which to save generated figures. (if `None`, figures will not be automatically
         saved)
+    timer : StageTimer (optional)
+        The timer in which to record the stages of the computations. (if `None`, nothing is
+        recorded)
 
     Returns
     -------
@@ -572,6 +892,8 @@ def um_summary_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_path
     --------
     '''
 
+    timer = StageTimer(enabled=False) if timer is None else timer
+
     # Extract parameter values #
     # ------------------------ #
     bins = metrics_params['bins']
@@ -601,19 +923,32 @@ def um_summary_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_path
 
     # Always output raster as half of first row 
     # TODO change this so that raster takes up ~60% of first row
+    timer.start('summary metrics figure: raster')
     raster_ax = fig.add_subplot(nrows, 2, 1)
     raster_depth.scatter_with_boundary_times(alf_probe_path, clusters, ax=raster_ax)  # raster
     # Always output rf maps as second half of first row
     if not(certif_exists):
         warn("'_iblcertif_' extraction files not found. RF Map plots will not be generated.")
     else:
+        timer.start('summary metrics figure: rf mapping')
         rf_map_ax = [fig.add_subplot(nrows, 4, 3), fig.add_subplot(nrows, 4, 4)]
         rf_mapping.plot_rfs_by_depth_wrapper(  # rf maps
             alf_probe_path, axes=rf_map_ax, cluster_ids=clusters, method=rf_method,
-            binsize=rf_binsize, lags=rf_lags, n_depths=rf_n_depths, use_svd=use_svd)
+            binsize=rf_binsize, lags=rf_lags, n_depths=rf_n_depths, use_svd=use_svd,
+            n_jobs=rf_params.get('n_jobs', 1), chunk_size=rf_params.get('chunk_size'),
+            cache_dir=rf_params.get('cache_dir'), use_cache=rf_params.get('use_cache', True))
 
     # Get alf objects for this session (needed for some metrics calculations below)
+    timer.start('summary metrics figure: unit metrics')
     clstrs_b = aio.load_object(alf_probe_path, 'clusters')
+    # Compute all the per-unit metrics to plot at once
+    metrics_table = compute_unit_metrics(
+        units_b, units=clusters, metrics=[metric for metric in UNIT_METRICS if metric in metrics],
+        rp=rp, spks_per_bin=spks_per_bin, sigma=sigma, fr_hist_win=fr_hist_win,
+        fr_ma_win=fr_ma_win, n_cv_bins=n_cv_bins, pr_hist_win=pr_hist_win)
+    m['unit_metrics'] = metrics_table
+
+    timer.start('summary metrics figure: plots')
 
     if 'feat_vars' in metrics:  # coefficients of variation of amplitudes barplot
         feat_vars_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
@@ -630,48 +965,51 @@ def um_summary_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_path
     if 'cv_fr' in metrics:  # coefficient of variation of firing rates hist
         cv_fr_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         cv_fr = cv_fr_hist(units_b, units=clusters, hist_win=fr_hist_win, fr_win=fr_ma_win,
-                           n_cv_bins=n_cv_bins, bins=bins, ax=cv_fr_ax)
+                           n_cv_bins=n_cv_bins, bins=bins, ax=cv_fr_ax,
+                           metrics_table=metrics_table)
         m['cv_fr'] = cv_fr
         n_cur_ax += 1
     if 'spks_missed' in metrics:  # fraction missing spikes hist
         spks_missed_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         fraction_missing = spks_missed_hist(
             units_b, units=clusters, bins=bins, spks_per_bin=spks_per_bin, sigma=sigma,
-            ax=spks_missed_ax)
+            ax=spks_missed_ax, metrics_table=metrics_table)
         m['fraction_missing'] = fraction_missing
         n_cur_ax += 1
     if 'isi_viol' in metrics:  # fraction isi violations hist
         isi_viol_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
-        isi_viol = isi_viol_hist(units_b, units=clusters, rp=rp, bins=bins, ax=isi_viol_ax)
+        isi_viol = isi_viol_hist(units_b, units=clusters, rp=rp, bins=bins, ax=isi_viol_ax,
+                                 metrics_table=metrics_table)
         m['isi_viol'] = isi_viol
         n_cur_ax += 1
     if 'max_drift_depth' in metrics:  # max_drift depth hist
         max_drift_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         max_drift_depth = max_drift_hist(units_b, feat_name='depth', units=clusters, bins=bins,
-                                         ax=max_drift_ax)
+                                         ax=max_drift_ax, metrics_table=metrics_table)
         m['max_drift_depth'] = max_drift_depth
         n_cur_ax += 1
     if 'cum_drift_depth' in metrics:  # cum_drift depth hist
         cum_drift_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         cum_drift_depth = cum_drift_hist(units_b, feat_name='depth', units=clusters, bins=bins,
-                                         ax=cum_drift_ax)
+                                         ax=cum_drift_ax, metrics_table=metrics_table)
         m['cum_drift_depth'] = cum_drift_depth
         n_cur_ax += 1
     if 'max_drift_amp' in metrics:  # max_drift amp hist
         max_drift_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         max_drift_amp = max_drift_hist(units_b, feat_name='amp', units=clusters, bins=bins,
-                                       ax=max_drift_ax)
+                                       ax=max_drift_ax, metrics_table=metrics_table)
         m['max_drift_amp'] = max_drift_amp
         n_cur_ax += 1
     if 'cum_drift_amp' in metrics:  # cum_drift amp hist
         cum_drift_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
         cum_drift_amp = cum_drift_hist(units_b, feat_name='amp', units=clusters, bins=bins,
-                                       ax=cum_drift_ax)
+                                       ax=cum_drift_ax, metrics_table=metrics_table)
         m['cum_drift_amp'] = cum_drift_amp
         n_cur_ax += 1
     if 'pres_ratio' in metrics:  # presence ratio hist
         pr_ax = fig.add_subplot(nrows, ncols, n_cur_ax)
-        pr = pr_hist(units_b, units=clusters, hist_win=pr_hist_win, bins=bins, ax=pr_ax)
+        pr = pr_hist(units_b, units=clusters, hist_win=pr_hist_win, bins=bins, ax=pr_ax,
+                     metrics_table=metrics_table)
         m['pres_ratio'] = pr
         n_cur_ax += 1
     # TODO add this
@@ -880,8 +1218,137 @@ def um_selected_plots(clusters, metrics, units_b, alf_probe_path, ephys_file_pat
     plt.rcdefaults()  # restore matplotlib rc defaults
     return fig, m
 
+def extract_waveforms_batch(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype='int16',
+                            car=False):
+    '''
+    Extracts several sets of waveforms (e.g. for several units) from a binary ephys file in a
+    single pass, reading each required window of raw data once and in time order.
+
+    Parameters
+    ----------
+    ephys_file : string
+        The file path to the binary ephys data.
+    ts : list of ndarrays
+        The timestamps (in s) of the spikes of each set of waveforms.
+    ch : list of ndarrays
+        The channels on which to extract the waveforms of each set.
+    t : float (optional)
+        The time (in ms) of each returned waveform, centered on its timestamp.
+    sr : int (optional)
+        The sampling rate (in hz) that the ephys data was acquired at.
+    n_ch_probe : int (optional)
+        The number of channels of the recording.
+    dtype : str (optional)
+        The datatype represented by the bytes in `ephys_file`.
+    car : bool (optional)
+        A flag to perform common-average-referencing (as in `brainbox.io.extract_waveforms`).
+
+    Returns
+    -------
+    waveforms : list of ndarrays
+        For each set, an array of shape (n_spikes, n_samples, n_channels) with the same values as
+        `brainbox.io.extract_waveforms` would return for this set. The samples of windows which
+        extend before the start or past the end of the recording are 0.
+
+    See Also
+    --------
+    brainbox.io.extract_waveforms
+    '''
+
+    item_bytes = np.dtype(dtype).itemsize
+    n_samples = os.path.getsize(ephys_file) // (item_bytes * n_ch_probe)
+    file_m = np.memmap(ephys_file, shape=(n_samples, n_ch_probe), dtype=dtype, mode='r')
+    n_wf_samples = int(sr / 1000 * (t / 2))  # number of samples on each side of a timestamp
+    waveforms = [np.zeros((len(ts_i), 2 * n_wf_samples, len(ch_i))) for ts_i, ch_i in zip(ts, ch)]
+    # (set, spike) of every requested waveform, ordered by the first sample of its window
+    set_idxs = np.repeat(np.arange(len(ts)), [len(ts_i) for ts_i in ts])
+    spk_idxs = np.concatenate([np.arange(len(ts_i)) for ts_i in ts] + [np.zeros(0, dtype=int)])
+    starts = np.concatenate(
+        [np.array(ts_i * sr).astype(int) for ts_i in ts] + [np.zeros(0, dtype=int)])
+    starts -= n_wf_samples
+    order = np.argsort(starts, kind='stable')
+    # read each distinct window once, for all channels, and distribute it to its waveforms
+    last_start, window = None, None
+    for k in order:
+        if starts[k] != last_start:
+            last_start = starts[k]
+            # clip the window to the recording, and zero-pad it
+            first, last = max(last_start, 0), min(last_start + 2 * n_wf_samples, n_samples)
+            window = np.zeros((2 * n_wf_samples, n_ch_probe), dtype=dtype)
+            if first < last:
+                window[first - last_start:last - last_start] = file_m[first:last]
+        waveforms[set_idxs[k]][spk_idxs[k]] = window[:, ch[set_idxs[k]]]
+    if car:  # subtract the temporal median, then the spatial median
+        for wf in waveforms:
+            wf -= np.median(wf, axis=1)[:, np.newaxis, :]
+            wf -= np.median(wf, axis=2)[:, :, np.newaxis]
+    return waveforms
+
+
+def get_units_waveforms(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10,
+                        sr=30000, n_ch_probe=385, dtype='int16', car=False):
+    '''
+    Extracts the first and last `n_spks` waveforms of each of `units`, around its channel of max
+    amplitude, in a single pass over the raw data (see `extract_waveforms_batch`). The output can
+    be shared by all plots that need these waveforms (e.g. `s_hist`).
+
+    Parameters
+    ----------
+    ephys_file : string
+        The file path to the binary ephys data.
+    units_b : bunch
+        A units bunch containing fields with spike information (e.g. cluster IDs, times, features,
+        etc.) for all units.
+    clstrs_b : bunch
+        A clusters bunch containing fields with cluster information (e.g. amp, ch of max amp, depth
+        of ch of max amp, etc.) for all clusters.
+    units : ndarray (optional)
+        The units for which to extract waveforms. (if `None`, all units are used)
+    n_spks : int (optional)
+        The max first and last number of spikes for which to extract waveforms.
+    n_ch : int (optional)
+        The number of channels around the channel of max amplitude to extract waveforms on.
+    sr : int (optional)
+        The sampling rate (in hz) that the ephys data was acquired at.
+    n_ch_probe : int (optional)
+        The number of channels of the recording.
+    dtype : str (optional)
+        The datatype represented by the bytes in `ephys_file`.
+    car : bool (optional)
+        A flag to perform common-average-referencing before extracting waveforms.
+
+    Returns
+    -------
+    waveforms : dict
+        Keys are units (as strings), values are tuples of the waveforms of the first and last
+        `n_spks` spikes of the unit. Empty units are left out.
+    '''
+
+    # Get units.
+    if units is None:  # we're using all units
+        units = list(units_b['times'].keys())
+
+    units = [str(unit) for unit in units if len(units_b['times'][str(unit)]) > 0]
+    ts, ch = [], []
+    for unit in units:
+        # Get the channel of max amplitude and `n_ch` around it.
+        max_ch = clstrs_b['channels'][int(unit)]
+        n_c_ch = n_ch // 2
+        if max_ch < n_c_ch:  # take only channels greater than `max_ch`.
+            ch_unit = np.arange(max_ch, max_ch + n_ch)
+        elif (max_ch + n_c_ch) > n_ch_probe:  # take only channels less than `max_ch`.
+            ch_unit = np.arange(max_ch - n_ch, max_ch)
+        else:  # take `n_c_ch` around `max_ch`.
+            ch_unit = np.arange(max_ch - n_c_ch, max_ch + n_c_ch)
+        ts.extend([units_b['times'][unit][:n_spks], units_b['times'][unit][-n_spks:]])
+        ch.extend([ch_unit, ch_unit])
+    wfs = extract_waveforms_batch(
+        ephys_file, ts, ch, sr=sr, n_ch_probe=n_ch_probe, dtype=dtype, car=car)
+    return {unit: (wfs[2 * i], wfs[2 * i + 1]) for i, unit in enumerate(units)}
+
+
 def s_hist(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10, sr=30000,
-           n_ch_probe=385, dtype='int16', car=False, bins='auto', ax=None):
+           n_ch_probe=385, dtype='int16', car=False, bins='auto', ax=None, waveforms=None):
     '''
     Plots a histogram of 's' (the spatiotemporal similarity of two sets of waveforms, for the first
     and last `n_spks` waveforms of a unit) for all `units`.
@@ -916,6 +1383,9 @@ def s_hist(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10, sr=30
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional) 
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    waveforms : dict (optional)
+        The output of `get_units_waveforms` for `units`, if already computed. (if `None`, the
+        waveforms are extracted from `ephys_file`)
 
     Returns
     -------
@@ -925,6 +1395,7 @@ def s_hist(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10, sr=30
     See Also
     --------
     metrics.wf_similarity
+    get_units_waveforms
 
     Examples
     --------
@@ -934,29 +1405,21 @@ def s_hist(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10, sr=30
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
 
+    # Extract the first and last waveforms of all units in one pass over `ephys_file`.
+    if waveforms is None:
+        waveforms = get_units_waveforms(
+            ephys_file, units_b, clstrs_b, units=units, n_spks=n_spks, n_ch=n_ch, sr=sr,
+            n_ch_probe=n_ch_probe, dtype=dtype, car=car)
+
     # Calculate 's'.
     s = np.ones(len(units),)
     for i, unit in enumerate(units):
-        # Get the channel of max amplitude and `n_ch` around it.
         # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
         if len(units_b['times'][str(unit)]) == 0:
             s[i] = np.nan
             continue
-        ts1 = units_b['times'][str(unit)][:n_spks]
-        ts2 = units_b['times'][str(unit)][-n_spks:]
-        max_ch = clstrs_b['channels'][unit]
-        n_c_ch = n_ch // 2
-        if max_ch < n_c_ch:  # take only channels greater than `max_ch`.
-            ch = np.arange(max_ch, max_ch + n_ch)
-        elif (max_ch + n_c_ch) > n_ch_probe:  # take only channels less than `max_ch`.
-            ch = np.arange(max_ch - n_ch, max_ch)
-        else:  # take `n_c_ch` around `max_ch`.
-            ch = np.arange(max_ch - n_c_ch, max_ch + n_c_ch)
-        # Extract the waveforms for these timestamps and compute similarity score.
-        wf1 = bb.io.extract_waveforms(ephys_file, ts1, ch, sr=sr, n_ch_probe=n_ch_probe,
-                                      dtype=dtype, car=car)
-        wf2 = bb.io.extract_waveforms(ephys_file, ts2, ch, sr=sr, n_ch_probe=n_ch_probe,
-                                      dtype=dtype, car=car)
+        # Compute similarity score of the first and last waveforms.
+        wf1, wf2 = waveforms[str(unit)]
         s[i] = bb.metrics.wf_similarity(wf1, wf2)
 
     # Plot histogram.
@@ -971,8 +1434,318 @@ def s_hist(ephys_file, units_b, clstrs_b, units=None, n_spks=100, n_ch=10, sr=30
     return s
 
 
+UNIT_METRICS = ['cv_fr', 'spks_missed', 'isi_viol', 'max_drift_depth', 'cum_drift_depth',
+                'max_drift_amp', 'cum_drift_amp', 'pres_ratio']
+
+
+def compute_unit_metrics(units_b, units=None, metrics=None, rp=0.002, spks_per_bin=20, sigma=5,
+                         fr_hist_win=0.01, fr_ma_win=0.05, n_cv_bins=10, pr_hist_win=10):
+    '''
+    Computes unit metrics for all `units` at once and returns them as a table. The metrics which
+    only depend on consecutive spikes or on per-unit extrema ('isi_viol', 'max_drift_*',
+    'cum_drift_*', 'pres_ratio') are computed for all units in a single pass over the
+    concatenated spike trains; 'cv_fr' and 'spks_missed' are computed unit by unit with
+    `brainbox.metrics`.
+
+    Parameters
+    ----------
+    units_b : bunch
+        A units bunch containing fields with spike information (e.g. cluster IDs, times, features,
+        etc.) for all units.
+    units : ndarray (optional)
+        The units for which to compute the metrics. (if `None`, metrics are computed for all
+        units)
+    metrics : list (optional)
+        The metrics to compute, amongst `UNIT_METRICS`. (if `None`, all are computed)
+    rp : float (optional)
+        The refractory period (in s) for 'isi_viol'.
+    spks_per_bin : int (optional)
+        The number of spikes per bin from which to compute the spike amplitude histogram for
+        'spks_missed'.
+    sigma : int (optional)
+        The standard deviation for the gaussian kernel used to compute the pdf from the spike
+        amplitude histogram for 'spks_missed'.
+    fr_hist_win : float (optional)
+        The time window (in s) to use for computing spike counts for the instantaneous
+        firing rate for 'cv_fr'.
+    fr_ma_win : float (optional)
+        The time window (in s) to use as a moving slider to compute the instantaneous
+        firing rate for 'cv_fr'.
+    n_cv_bins : int (optional)
+        The number of equally spaced bins in time in which to compute 'cv_fr'.
+    pr_hist_win : float (optional)
+        The time window (in s) to use for computing spike counts for 'pres_ratio'.
+
+    Returns
+    -------
+    metrics_table : DataFrame
+        A table indexed by unit, with a column for each of `metrics`. Values are NaN for empty
+        units.
+
+    See Also
+    --------
+    metrics.isi_viol
+    metrics.max_drift
+    metrics.cum_drift
+    metrics.pres_ratio
+    metrics.firing_rate_coeff_var
+    metrics.feat_cutoff
+    '''
+
+    # Get units.
+    if units is None:  # we're using all units
+        units = list(units_b['times'].keys())
+    metrics = UNIT_METRICS if metrics is None else metrics
+
+    # Concatenate the spikes of all units; `spk_units` is the row of the unit of each spike.
+    n_units = len(units)
+    n_spks = np.array([len(units_b['times'][str(unit)]) for unit in units], dtype=int)
+    starts = np.cumsum(n_spks) - n_spks
+    spk_units = np.repeat(np.arange(n_units), n_spks)
+    same_unit = spk_units[1:] == spk_units[:-1]  # pairs of consecutive spikes of a unit
+    non_empty = n_spks > 0
+
+    def _concat(feat):
+        if n_units == 0:
+            return np.zeros(0)
+        return np.concatenate([units_b[feat][str(unit)] for unit in units])
+
+    table = {}
+    if 'isi_viol' in metrics or 'pres_ratio' in metrics:
+        ts = _concat('times')
+    if 'isi_viol' in metrics:
+        viol = (np.diff(ts) < rp) & same_unit
+        n_viol = np.bincount(spk_units[1:][viol], minlength=n_units)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table['isi_viol'] = n_viol / (n_spks - 1.)
+    for feat_name, feat_key, scale in (('depth', 'depths', 1), ('amp', 'amps', 1e6)):
+        if ('max_drift_' + feat_name) not in metrics and ('cum_drift_' + feat_name) not in metrics:
+            continue
+        feat = _concat(feat_key) * scale
+        if ('max_drift_' + feat_name) in metrics:
+            md = np.full(n_units, np.nan)
+            if np.any(non_empty):
+                md[non_empty] = (np.maximum.reduceat(feat, starts[non_empty]) -
+                                 np.minimum.reduceat(feat, starts[non_empty]))
+            table['max_drift_' + feat_name] = md
+        if ('cum_drift_' + feat_name) in metrics:
+            abs_diffs = np.abs(np.diff(feat))[same_unit]
+            cd = np.bincount(spk_units[1:][same_unit], weights=abs_diffs, minlength=n_units)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                table['cum_drift_' + feat_name] = cd / n_spks
+    if 'pres_ratio' in metrics:
+        # `pr_hist_win` bins from 0 to the last spike of each unit, as in `metrics.pres_ratio`
+        last_ts = np.zeros(n_units)
+        last_ts[non_empty] = ts[starts[non_empty] + n_spks[non_empty] - 1]
+        n_bins = np.ceil((last_ts + pr_hist_win) / pr_hist_win).astype(int) - 1
+        spk_bins = np.minimum(np.floor(ts / pr_hist_win).astype(int), n_bins[spk_units] - 1)
+        # count the distinct (unit, bin) pairs, i.e. the bins with at least one spike
+        occupied = np.unique(spk_units.astype(np.int64) * (np.max(n_bins) + 1) + spk_bins)
+        n_occupied = np.bincount(occupied // (np.max(n_bins) + 1), minlength=n_units)
+        pr = np.full(n_units, np.nan)
+        pr[non_empty] = n_occupied[non_empty] / n_bins[non_empty]
+        table['pres_ratio'] = pr
+    if 'cv_fr' in metrics:
+        cv_fr = np.full(n_units, np.nan)
+        for i in np.nonzero(non_empty)[0]:
+            cv_fr[i], _, _ = bb.metrics.firing_rate_coeff_var(
+                units_b['times'][str(units[i])], hist_win=fr_hist_win, fr_win=fr_ma_win,
+                n_bins=n_cv_bins)
+        table['cv_fr'] = cv_fr
+    if 'spks_missed' in metrics:
+        frac_missing = np.full(n_units, np.nan)
+        for i in np.nonzero(non_empty)[0]:
+            try:  # need a minimum number of spikes for `feat_cutoff`
+                frac_missing[i], _, _ = bb.metrics.feat_cutoff(
+                    units_b['amps'][str(units[i])], spks_per_bin=spks_per_bin, sigma=sigma)
+            except:  # if didn't meet min num spikes requirement, leave as nan
+                pass
+        table['spks_missed'] = frac_missing
+    for metric in table:
+        table[metric][~non_empty] = np.nan
+    index = pd.Index([int(unit) for unit in units], name='unit')
+    return pd.DataFrame({metric: table[metric] for metric in metrics}, index=index)
+
+
+def _get_metric(metrics_table, metric, units):
+    '''
+    Gets the values of a metric for `units` (in this order) from the output of
+    `compute_unit_metrics`.
+    '''
+
+    return metrics_table.loc[[int(unit) for unit in units], metric].to_numpy(dtype=float)
+
+
+def compute_filter_metrics(units_b, T, units=None, rp=0.002):
+    '''
+    Computes, for all `units` at once, the quality metrics used to filter units: mean amplitude,
+    firing rate and false positive rate, as defined in `brainbox.processing.filter_units`.
+    Filtering the returned table with `filter_units_from_table` is then fast enough to sweep
+    thresholds without another pass over the spikes.
+
+    Parameters
+    ----------
+    units_b : bunch
+        A units bunch containing fields with spike information (e.g. cluster IDs, times, features,
+        etc.) for all units.
+    T : float
+        Duration of the recording session (in s).
+    units : ndarray (optional)
+        The units for which to compute the metrics. (if `None`, metrics are computed for all
+        units)
+    rp : float (optional)
+        The refractory period (in s) used to calculate the false positive rate.
+
+    Returns
+    -------
+    filter_table : DataFrame
+        A table indexed by unit, with columns:
+            'n_spikes' : The number of spikes of the unit.
+            'mean_amp' : The mean amplitude (in V) of the spikes of the unit.
+            'fr' : The firing rate (in Hz) of the unit, over the time between its first and last
+                spikes (inf for units with a single spike).
+            'fpr' : The false positive rate of the unit: the smallest root, in absolute value, of
+                `-fpr ** 2 + fpr + c = 0`, where `c = T * n_viol / (2 * rp * n_spikes ** 2)` and
+                `n_viol` is the number of refractory period violations.
+        Values other than 'n_spikes' are NaN for empty units.
+
+    See Also
+    --------
+    filter_units_from_table
+    brainbox.processing.filter_units
+    '''
+
+    # Get units.
+    if units is None:  # we're using all units
+        units = list(units_b['times'].keys())
+
+    # Concatenate the spikes of all units.
+    n_spks = np.array([len(units_b['times'][str(unit)]) for unit in units], dtype=int)
+    if len(units) == 0:
+        ts = amps = np.zeros(0)
+    else:
+        ts = np.concatenate([units_b['times'][str(unit)] for unit in units])
+        amps = np.concatenate([units_b['amps'][str(unit)] for unit in units])
+    return _get_filter_table(ts, amps, n_spks, units, T, rp)
+
+
+def compute_filter_metrics_from_spikes(spks_b, T, units=None, rp=0.002):
+    '''
+    Computes the same table as `compute_filter_metrics` directly from the spikes bunch, without
+    building a units bunch (e.g. to select the units of figures which do not need a units bunch).
+
+    Parameters
+    ----------
+    spks_b : bunch
+        A spikes bunch containing fields with spike information (e.g. cluster IDs, times, amps,
+        etc.) for all spikes.
+    T : float
+        Duration of the recording session (in s).
+    units : ndarray (optional)
+        The units for which to compute the metrics. (if `None`, metrics are computed for all
+        units from 0 to the largest cluster id, as in `brainbox.processing.get_units_bunch`)
+    rp : float (optional)
+        The refractory period (in s) used to calculate the false positive rate.
+
+    Returns
+    -------
+    filter_table : DataFrame
+        See `compute_filter_metrics`.
+    '''
+
+    clusters = np.asarray(spks_b['clusters']).astype(np.int64)
+    if units is None:
+        units = np.arange(np.max(clusters) + 1 if clusters.size else 0)
+    units = np.asarray(units).astype(np.int64)
+    # Group the spikes by unit, in the order of `units`, keeping their order within each unit
+    # (as in a units bunch); spikes of other units are dropped.
+    unit_rows = np.full(max(np.max(units, initial=-1), np.max(clusters, initial=-1)) + 1, -1)
+    unit_rows[units] = np.arange(len(units))
+    spk_rows = unit_rows[clusters]
+    keep = np.nonzero(spk_rows >= 0)[0]
+    order = keep[np.argsort(spk_rows[keep], kind='stable')]
+    n_spks = np.bincount(spk_rows[keep], minlength=len(units))
+    ts = np.asarray(spks_b['times'])[order]
+    amps = np.asarray(spks_b['amps'])[order]
+    return _get_filter_table(ts, amps, n_spks, units, T, rp)
+
+
+def _get_filter_table(ts, amps, n_spks, units, T, rp):
+    '''
+    Computes the table of `compute_filter_metrics` from the spike times `ts` and amplitudes
+    `amps` of all `units`, concatenated unit by unit (`n_spks` spikes per unit).
+    '''
+
+    # `spk_units` is the row of the unit of each spike.
+    n_units = len(units)
+    spk_units = np.repeat(np.arange(n_units), n_spks)
+
+    # index of the first and last spikes of each non-empty unit in `ts`
+    last = np.cumsum(n_spks) - 1
+    first = last - n_spks + 1
+    nonempty = n_spks > 0
+    span = np.full(n_units, np.nan)
+    span[nonempty] = ts[last[nonempty]] - ts[first[nonempty]]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_amp = np.bincount(spk_units, weights=amps, minlength=n_units) / n_spks
+        fr = n_spks / span
+        # refractory period violations: consecutive spikes of a unit closer than `rp`
+        viol = (np.diff(ts) < rp) & (spk_units[1:] == spk_units[:-1])
+        n_viol = np.bincount(spk_units[1:][viol], minlength=n_units)
+        c = T * n_viol / (2 * rp * n_spks.astype(float) ** 2)
+        # roots of `-x ** 2 + x + c` are `(1 +/- sqrt(1 + 4c)) / 2`; for `c >= 0` the smallest
+        # in absolute value is `(sqrt(1 + 4c) - 1) / 2`
+        fpr = (np.sqrt(1 + 4 * c) - 1) / 2
+    fpr[~nonempty] = np.nan
+    index = pd.Index([int(unit) for unit in units], name='unit')
+    return pd.DataFrame(
+        {'n_spikes': n_spks, 'mean_amp': mean_amp, 'fr': fr, 'fpr': fpr}, index=index)
+
+
+def filter_units_from_table(filter_table, min_amp=50e-6, min_fr=0.5, max_fpr=0.1):
+    '''
+    Filters units like `brainbox.processing.filter_units`, but using the metrics precomputed by
+    `compute_filter_metrics`. Empty units are always removed, and a threshold which is `None` is
+    not applied. The default thresholds are those of `filt_params` in `gen_figures`.
+
+    Parameters
+    ----------
+    filter_table : DataFrame
+        The output of `compute_filter_metrics`.
+    min_amp : float (optional)
+        The minimum mean amplitude (in V) of the spikes in the unit.
+    min_fr : float (optional)
+        The minimum firing rate (in Hz) of the unit.
+    max_fpr : float (optional)
+        The maximum false positive rate of the unit. (the refractory period is the one used in
+        `compute_filter_metrics`)
+
+    Returns
+    -------
+    filt_units : ndarray
+        The ids of the units which pass all thresholds.
+
+    Examples
+    --------
+    Sweep the minimum amplitude without recomputing any metric:
+        >>> filter_table = compute_filter_metrics(units_b, T)
+        >>> n_units = [len(filter_units_from_table(filter_table, min_amp=a))
+        ...            for a in [30e-6, 50e-6, 70e-6]]
+    '''
+
+    keep = filter_table['n_spikes'].to_numpy() > 0
+    if min_amp is not None:
+        keep &= filter_table['mean_amp'].to_numpy() > min_amp
+    if min_fr is not None:
+        keep &= filter_table['fr'].to_numpy() > min_fr
+    if max_fpr is not None:
+        keep &= filter_table['fpr'].to_numpy() < max_fpr
+    return filter_table.index.to_numpy()[keep].astype(int)
+
+
 def cv_fr_hist(units_b, units=None, hist_win=0.01, fr_win=0.05, n_cv_bins=10, bins='auto',
-               ax=None):
+               ax=None, metrics_table=None):
     '''
     Plots a histogram of coefficient of variation of firing rate for all `units`.
 
@@ -998,6 +1771,9 @@ def cv_fr_hist(units_b, units=None, hist_win=0.01, fr_win=0.05, n_cv_bins=10, bi
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1016,16 +1792,12 @@ def cv_fr_hist(units_b, units=None, hist_win=0.01, fr_win=0.05, n_cv_bins=10, bi
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
     
-    # Calculate coefficient of variation of firing rate.
-    cv_fr = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            cv_fr[i] = np.nan
-            continue
-        ts = units_b['times'][str(unit)]
-        cv_fr[i], _, _ = bb.metrics.firing_rate_coeff_var(ts, hist_win=hist_win, fr_win=fr_win,
-                                                          n_bins=n_cv_bins)
+    # Get coefficient of variation of firing rate.
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(
+            units_b, units=units, metrics=['cv_fr'], fr_hist_win=hist_win, fr_ma_win=fr_win,
+            n_cv_bins=n_cv_bins)
+    cv_fr = _get_metric(metrics_table, 'cv_fr', units)
 
     # Plot histogram.
     if ax is None:
@@ -1039,7 +1811,8 @@ def cv_fr_hist(units_b, units=None, hist_win=0.01, fr_win=0.05, n_cv_bins=10, bi
     return cv_fr
 
 
-def spks_missed_hist(units_b, units=None, spks_per_bin=20, sigma=5, bins='auto', ax=None):
+def spks_missed_hist(units_b, units=None, spks_per_bin=20, sigma=5, bins='auto', ax=None,
+                     metrics_table=None):
     '''
     Plots a histogram of the approximate fraction of spikes missing from a spike feature
     distribution (assuming the distribution is symmetric) for all `units`.
@@ -1062,6 +1835,9 @@ def spks_missed_hist(units_b, units=None, spks_per_bin=20, sigma=5, bins='auto',
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1080,20 +1856,13 @@ def spks_missed_hist(units_b, units=None, spks_per_bin=20, sigma=5, bins='auto',
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
     
-    # Calculate fraction of missing spikes for each unit.
-    frac_missing = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            frac_missing[i] = np.nan
-            continue
-        try:  # need a minimum number of spikes for `feat_cutoff`
-            amps = units_b['amps'][str(unit)]
-            frac_missing[i], _, _ = bb.metrics.feat_cutoff(
-                amps, spks_per_bin=spks_per_bin, sigma=sigma)
-        except:  # if didn't meet min num spikes requirement, set as nan
-            frac_missing[i] = np.nan    
-    
+    # Get fraction of missing spikes for each unit.
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(
+            units_b, units=units, metrics=['spks_missed'], spks_per_bin=spks_per_bin,
+            sigma=sigma)
+    frac_missing = _get_metric(metrics_table, 'spks_missed', units)
+
     # Plot histogram.
     if ax is None:
         fig, ax = plt.subplots()
@@ -1106,7 +1875,7 @@ def spks_missed_hist(units_b, units=None, spks_per_bin=20, sigma=5, bins='auto',
     return frac_missing
 
 
-def isi_viol_hist(units_b, units=None, rp=0.002, bins='auto', ax=None):
+def isi_viol_hist(units_b, units=None, rp=0.002, bins='auto', ax=None, metrics_table=None):
     '''
     Plots a histogram of fraction of isi violations for all `units`.
 
@@ -1125,6 +1894,9 @@ def isi_viol_hist(units_b, units=None, rp=0.002, bins='auto', ax=None):
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1143,16 +1915,11 @@ def isi_viol_hist(units_b, units=None, rp=0.002, bins='auto', ax=None):
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
     
-    # Calculate fraction of isi violations for each unit.
-    frac_isi_viol = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            frac_isi_viol[i] = np.nan
-            continue
-        ts = units_b['times'][str(unit)]
-        frac_isi_viol[i], _, _ = bb.metrics.isi_viol(ts, rp=rp)
-    
+    # Get fraction of isi violations for each unit.
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(units_b, units=units, metrics=['isi_viol'], rp=rp)
+    frac_isi_viol = _get_metric(metrics_table, 'isi_viol', units)
+
     # Plot histogram.
     if ax is None:
         fig, ax = plt.subplots()
@@ -1165,7 +1932,7 @@ def isi_viol_hist(units_b, units=None, rp=0.002, bins='auto', ax=None):
     return frac_isi_viol
 
 
-def max_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
+def max_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None, metrics_table=None):
     '''
     Plots a histogram of the maximum drift values for all `units`.
 
@@ -1184,6 +1951,9 @@ def max_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1202,22 +1972,17 @@ def max_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
     
-    # Calculate fraction of isi violations for each unit.
-    md = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            md[i] = np.nan
-            continue
-        if feat_name == 'depth':
-            feat = units_b['depths'][str(unit)]
-            tit =  "Depth Max Drift"
-            xlab = "Max Drift (mm)"
-        elif feat_name == 'amp':
-            feat = units_b['amps'][str(unit)] * 1e6  # convert to uV
-            tit =  "Amp Max Drift"
-            xlab = "Max Drift (uV)"
-        md[i] = bb.metrics.max_drift(feat)
+    # Get max drift for each unit.
+    if feat_name == 'depth':
+        tit =  "Depth Max Drift"
+        xlab = "Max Drift (mm)"
+    elif feat_name == 'amp':
+        tit =  "Amp Max Drift"
+        xlab = "Max Drift (uV)"
+    metric = 'max_drift_' + feat_name
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(units_b, units=units, metrics=[metric])
+    md = _get_metric(metrics_table, metric, units)
 
     # Plot histogram.
     if ax is None:
@@ -1231,7 +1996,7 @@ def max_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
     return md
 
 
-def cum_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
+def cum_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None, metrics_table=None):
     '''
     Plots a histogram of the cumulative drift values for all `units`.
 
@@ -1250,6 +2015,9 @@ def cum_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1269,22 +2037,17 @@ def cum_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
 
-    # Calculate fraction of isi violations for each unit.
-    cd = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            cd[i] = np.nan
-            continue
-        if feat_name == 'depth':
-            feat = units_b['depths'][str(unit)]
-            tit =  "Depth Cumulative Drift"
-            xlab = "Mean Cumulative Drift (mm)"
-        elif feat_name == 'amp':
-            feat = units_b['amps'][str(unit)] * 1e6  # convert to uV
-            tit =  "Amp Cumulative Drift"
-            xlab = "Mean Cumulative Drift (uV)"
-        cd[i] = bb.metrics.cum_drift(feat)
+    # Get cumulative drift for each unit.
+    if feat_name == 'depth':
+        tit =  "Depth Cumulative Drift"
+        xlab = "Mean Cumulative Drift (mm)"
+    elif feat_name == 'amp':
+        tit =  "Amp Cumulative Drift"
+        xlab = "Mean Cumulative Drift (uV)"
+    metric = 'cum_drift_' + feat_name
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(units_b, units=units, metrics=[metric])
+    cd = _get_metric(metrics_table, metric, units)
 
     # Plot histogram.
     if ax is None:
@@ -1297,7 +2060,7 @@ def cum_drift_hist(units_b, feat_name, units=None, bins='auto', ax=None):
 
     return cd
 
-def pr_hist(units_b, units=None, hist_win=10, bins='auto', ax=None):
+def pr_hist(units_b, units=None, hist_win=10, bins='auto', ax=None, metrics_table=None):
     '''
     Plots a histogram of the presence ratio for all `units`.
 
@@ -1316,6 +2079,9 @@ def pr_hist(units_b, units=None, hist_win=10, bins='auto', ax=None):
         the method to use to compute the optimal number of bins (see `numpy.histogram_bin_edges`).
     ax : axessubplot (optional)
         The axis handle to plot the histogram on. (if `None`, a new figure and axis is created)
+    metrics_table : DataFrame (optional)
+        The output of `compute_unit_metrics` for (at least) `units`, if already computed. (if
+        `None`, the metric is computed here)
 
     Returns
     -------
@@ -1334,15 +2100,11 @@ def pr_hist(units_b, units=None, hist_win=10, bins='auto', ax=None):
     if units is None:  # we're using all units
         units = list(units_b['times'].keys())
     
-    # Calculate presence ratios.
-    pr = np.ones(len(units),)
-    for i, unit in enumerate(units):
-        # If empty unit returned by spike sorter, create a NaN placeholder and skip it:
-        if len(units_b['times'][str(unit)]) == 0:
-            pr[i] = np.nan
-            continue
-        ts = units_b['times'][str(unit)]
-        pr[i], _ = bb.metrics.pres_ratio(ts, hist_win=hist_win)
+    # Get presence ratios.
+    if metrics_table is None:
+        metrics_table = compute_unit_metrics(
+            units_b, units=units, metrics=['pres_ratio'], pr_hist_win=hist_win)
+    pr = _get_metric(metrics_table, 'pres_ratio', units)
 
     # Plot histogram.
     if ax is None:
@@ -1354,3 +2116,30 @@ def pr_hist(units_b, units=None, hist_win=10, bins='auto', ax=None):
     ax.set_ylabel('Count')
 
     return pr
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Generate V1 certification figures for several sessions, without displaying '
+                    'them (see `gen_figures_batch`).')
+    parser.add_argument('--eids', nargs='+', required=True, help='experiment IDs')
+    parser.add_argument('--probes', nargs='+', required=True,
+                        help='the probe of each eid, or a single probe for all eids')
+    parser.add_argument('--out-dir', required=True, help='directory in which to save outputs')
+    parser.add_argument('--figures', nargs='+', default=FIGURES, choices=FIGURES,
+                        help='figures to generate (default: all)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random selection of units')
+    parser.add_argument('--report-timing', action='store_true',
+                        help='save the wall time and peak memory of each stage')
+    parser.add_argument('--force-extract', action='store_true',
+                        help='re-extract stimulus info even if it is up to date')
+    args = parser.parse_args()
+    outputs = gen_figures_batch(
+        args.eids, args.probes, args.out_dir, figures=args.figures, seed=args.seed,
+        report_timing=args.report_timing, force_extract_stim_info=args.force_extract)
+    failed = [key for key, out in outputs.items() if isinstance(out, Exception)]
+    if failed:
+        raise SystemExit('Failed for {}'.format(failed))
@@ -23,26 +23,55 @@ def _get_spike_counts_in_bins(spike_times, spike_clusters, intervals=None):
     assert intervals.shape[1] == 2
     n_intervals = intervals.shape[0]
 
-    # For each neuron and each interval, the number of spikes in the interval.
-    neuron_ids = np.unique(spike_clusters)
+    # Sort spikes once so that each interval is a contiguous slice of the spike train.
+    neuron_ids, neuron_idxs = np.unique(spike_clusters, return_inverse=True)
     n_neurons = len(neuron_ids)
-    counts = np.zeros((n_neurons, n_intervals), dtype=np.uint32)
-    for j in range(n_intervals):
-        t0, t1 = intervals[j, :]
-        # Count the number of spikes in the window, for each neuron.
-        x = np.bincount(
-            spike_clusters[(t0 <= spike_times) & (spike_times < t1)],
-            minlength=neuron_ids.max() + 1)
-        counts[:, j] = x[neuron_ids]
+    if np.any(np.diff(spike_times) < 0):
+        isort = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[isort]
+        neuron_idxs = neuron_idxs[isort]
+
+    # For each neuron and each interval, the number of spikes in the interval.
+    interval_idxs, spike_idxs = _get_spikes_in_windows(
+        spike_times, intervals[:, 0], intervals[:, 1])
+    counts = np.bincount(
+        neuron_idxs[spike_idxs] * n_intervals + interval_idxs, minlength=n_neurons * n_intervals)
+    counts = counts.reshape((n_neurons, n_intervals)).astype(np.uint32)
     return counts  # value (i, j) is the number of spikes of neuron `neurons[i]` in interval #j
 
 
+def _get_spikes_in_windows(spike_times, t_beg, t_end, closed='left'):
+    """Find all spikes that fall in each of a set of time windows `[t_beg, t_end)`; the cost is
+    linear in the number of (window, spike) pairs rather than in windows times spikes.
+
+    :param spike_times: sorted times of spikes, in seconds
+    :type spike_times: 1D array
+    :param t_beg: window start times
+    :type t_beg: 1D array
+    :param t_end: window end times
+    :type t_end: 1D array, same length as t_beg
+    :param closed: 'left' for windows `[t_beg, t_end)`, 'right' for windows `(t_beg, t_end]`,
+    'both' for windows `[t_beg, t_end]`
+    :type closed: str
+    :rtype: tuple of 1D arrays `(window_idxs, spike_idxs)`, one entry for each (window, spike) pair
+    """
+    i_beg = np.searchsorted(spike_times, t_beg, side='right' if closed == 'right' else 'left')
+    i_end = np.searchsorted(spike_times, t_end, side='left' if closed == 'left' else 'right')
+    n_spikes = np.clip(i_end - i_beg, 0, None)
+    window_idxs = np.repeat(np.arange(len(i_beg)), n_spikes)
+    # position of each pair within its window, offset by the first spike in the window
+    offsets = np.arange(np.sum(n_spikes)) - np.repeat(np.cumsum(n_spikes) - n_spikes, n_spikes)
+    spike_idxs = np.repeat(i_beg, n_spikes) + offsets
+    return window_idxs, spike_idxs
+
+
 def are_neurons_responsive(
         spike_times, spike_clusters,
         stimulus_intervals=None, stimulus_types=None, spontaneous_period=None,
-        p_value_threshold=.05):
+        p_value_threshold=.05, return_p_values=False, rng=None):
     """Return which neurons are responsive after specific stimulus events, compared to
-    spontaneous activity, according to a Wilcoxon test.
+    spontaneous activity, according to a Wilcoxon test. All neurons and stimulus types are tested
+    at once.
 
     :param spike_times: times of spikes, in seconds
     :type spike_times: 1D array
@@ -57,8 +86,15 @@ def are_neurons_responsive(
     :param spontaneous_period: 1D array with 2 elements
     :param p_value_threshold: the threshold for the p value in the Wilcoxon test.
     :type p_value_threshold: float
+    :param return_p_values: also return the p value of each neuron (Wilcoxon rank-sum tests of
+    all stimulus types, combined with Fisher's method)
+    :type return_p_values: bool
+    :param rng: source of randomness for subsampling the spontaneous intervals; `None` uses the
+    global state of the `random` module, an int seed or a `numpy.random.Generator` makes the
+    result deterministic (independently of any other random draws in the process)
+    :type rng: None, int or numpy.random.Generator
     :rtype: 1D boolean array with `n_neurons` elements (clusters are sorted by increasing cluster
-    id as appearing in spike_clusters).
+    id as appearing in spike_clusters); if `return_p_values`, a tuple `(responsive, p_values)`
     """
     stimulus_counts = _get_spike_counts_in_bins(spike_times, spike_clusters, stimulus_intervals)
     # Find spontaneous intervals.
@@ -71,24 +107,60 @@ def are_neurons_responsive(
         spike_times, spike_clusters, spontaneous_intervals)
     assert stimulus_counts.shape == stimulus_counts.shape
     assert stimulus_intervals.shape[0] == stimulus_types.shape[0]
-    # Generate the responsive vector (for every neuron, whether it is responsive)
-    responsive = np.zeros(stimulus_counts.shape[0], dtype=np.bool)
     n_neurons = stimulus_counts.shape[0]
-    for i in range(n_neurons):
-        stim_sig = np.zeros(np.unique(stimulus_types).shape)
-        for j, stim in enumerate(np.unique(stimulus_types)):
-            x = stimulus_counts[i, stimulus_types == stim]
-            y = spontaneous_counts[i, random.sample(
-                    range(spontaneous_counts.shape[1]), np.sum(stimulus_types == stim))]
-            try:
-                _, stim_sig[j] = scipy.stats.ranksums(x, y)
-            except ValueError:
-                pass
-        _, p = scipy.stats.combine_pvalues(stim_sig)
-        responsive[i] = p < p_value_threshold
+    stims, stim_idxs = np.unique(stimulus_types, return_inverse=True)
+    n_trials = np.bincount(stim_idxs, minlength=len(stims))
+    n_spontaneous = spontaneous_counts.shape[1]
+    if rng is None:
+        # Draw the spontaneous intervals compared to each (neuron, stimulus) pair from the global
+        # state, in the same order as a loop over neurons and stimuli would.
+        samples = [
+            [random.sample(range(n_spontaneous), n_trials[j]) for j in range(len(stims))]
+            for i in range(n_neurons)]
+    else:
+        rng = np.random.default_rng(rng)
+    # Wilcoxon rank-sum test of all neurons and stimuli with the same number of trials at once.
+    stim_sig = np.zeros((n_neurons, len(stims)))
+    for n in np.unique(n_trials):
+        js = np.nonzero(n_trials == n)[0]
+        x = np.stack([stimulus_counts[:, stim_idxs == j] for j in js], axis=1)
+        if rng is None:
+            sample_idxs = np.array([[samples[i][j] for j in js] for i in range(n_neurons)])
+        else:
+            # Random subsets without replacement for all (neuron, stimulus) pairs at once: the
+            # first `n` intervals of an independent shuffle of each row.
+            sample_idxs = rng.permuted(
+                np.broadcast_to(np.arange(n_spontaneous), (n_neurons, len(js), n_spontaneous)),
+                axis=-1)[..., :n]
+        y = spontaneous_counts[np.arange(n_neurons)[:, None, None], sample_idxs]
+        stim_sig[:, js] = _ranksums(x, y)
+    # Combine p values across stimuli with Fisher's method.
+    with np.errstate(divide='ignore'):
+        statistic = -2 * np.sum(np.log(stim_sig), axis=1)
+    p_values = scipy.stats.chi2.sf(statistic, 2 * len(stims))
+    responsive = p_values < p_value_threshold
+    if return_p_values:
+        return responsive, p_values
     return responsive
 
 
+def _ranksums(x, y):
+    """Two-sided Wilcoxon rank-sum test along the last axis, as in `scipy.stats.ranksums`.
+
+    :param x: first set of measurements
+    :type x: ND array
+    :param y: second set of measurements
+    :type y: ND array, same shape as x except for the last axis
+    :rtype: ND array of p values, with the shape of x without the last axis
+    """
+    n1, n2 = x.shape[-1], y.shape[-1]
+    ranked = scipy.stats.rankdata(np.concatenate((x, y), axis=-1), axis=-1)
+    s = np.sum(ranked[..., :n1], axis=-1)
+    expected = n1 * (n1 + n2 + 1) / 2.0
+    z = (s - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    return 2 * scipy.stats.norm.sf(np.abs(z))
+
+
 if __name__ == '__main__':
     from pathlib import Path
     # path = Path("~/Downloads/FlatIron/mainenlab/Subjects
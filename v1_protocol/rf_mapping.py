@@ -1,10 +1,122 @@
+import os
+from functools import partial
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
+try:
+    from cache import get_cache_path, hash_inputs, save_to_cache
+    from responsive import _get_spikes_in_windows
+    from stim_info import load_stim_info
+except ImportError:
+    from v1_protocol.cache import get_cache_path, hash_inputs, save_to_cache
+    from v1_protocol.responsive import _get_spikes_in_windows
+    from v1_protocol.stim_info import load_stim_info
 
+# part of the key of cached rfs; increment it whenever a change of the rf computations (or of
+# `ReceptiveFields.save`) changes the cached results
+RFS_CACHE_VERSION = 1
 
-def compute_rfs(spike_times, spike_clusters, stimulus_times, stimulus, lags=8, binsize=0.025):
+
+class ReceptiveFields(object):
+    """
+    Container for the "on" and "off" receptive fields of a set of clusters. All rfs are stored in
+    a single contiguous array of shape (2, n_clusters, ...) along with the id of each cluster.
+    Indexing with a subfield name returns a view of shape (n_clusters, ...), so a container can be
+    used wherever a `{'on': [...], 'off': [...]}` dict of per-cluster rfs is expected.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        array of shape (2, n_clusters, ...); the first dimension is ordered as `subs`
+    cluster_ids : array-like, optional
+        cluster id of each entry along the second dimension of `data`; if `NoneType`, clusters are
+        numbered from 0
+
+    """
+
+    subs = ('on', 'off')
+
+    def __init__(self, data, cluster_ids=None):
+        self.data = np.ascontiguousarray(data)
+        if cluster_ids is None:
+            cluster_ids = np.arange(self.data.shape[1])
+        self.cluster_ids = np.asarray(cluster_ids)
+        assert self.data.shape[:2] == (len(self.subs), len(self.cluster_ids))
+        self._cluster_idxs = {c: i for i, c in enumerate(self.cluster_ids.tolist())}
+
+    @classmethod
+    def from_dict(cls, rfs, cluster_ids=None):
+        """
+        Stack a dict of "on" and "off" rfs (values are lists of per-cluster arrays or stacked
+        arrays) into a container; containers are returned unchanged. Floating point rfs keep their
+        precision; other rfs (e.g. integer) are converted to float64
+        """
+        if isinstance(rfs, cls):
+            return rfs
+        arrays = [np.asarray(rfs[sub]) for sub in cls.subs]
+        dtype = np.result_type(*arrays)
+        if not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        return cls(np.stack([array.astype(dtype, copy=False) for array in arrays]),
+                   cluster_ids=cluster_ids)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """
+        Load a container saved with `ReceptiveFields.save`; use `mmap_mode='r'` to memory-map the
+        rfs instead of reading them into memory
+        """
+        return cls(np.load(os.path.join(path, 'rfs.data.npy'), mmap_mode=mmap_mode),
+                   cluster_ids=np.load(os.path.join(path, 'rfs.clusterIds.npy')))
+
+    def save(self, path):
+        """
+        Save the rfs and cluster ids as .npy files in the directory `path`
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'rfs.data.npy'), self.data)
+        np.save(os.path.join(path, 'rfs.clusterIds.npy'), self.cluster_ids)
+
+    @property
+    def n_clusters(self):
+        return len(self.cluster_ids)
+
+    def cluster(self, cluster_id):
+        """
+        Return a dict of "on" and "off" views of the rfs of a single cluster
+        """
+        i = self._cluster_idxs[cluster_id]
+        return {sub: self.data[j, i] for j, sub in enumerate(self.subs)}
+
+    def keys(self):
+        return list(self.subs)
+
+    def values(self):
+        return [self[sub] for sub in self.subs]
+
+    def items(self):
+        return list(zip(self.subs, self.values()))
+
+    def __getitem__(self, sub):
+        return self.data[self.subs.index(sub)]
+
+    def __iter__(self):
+        return iter(self.subs)
+
+    def __len__(self):
+        return len(self.subs)
+
+    def __contains__(self, sub):
+        return sub in self.subs
+
+    def __repr__(self):
+        return 'ReceptiveFields(n_clusters=%i, shape=%s)' % (
+            self.n_clusters, str(self.data.shape[2:]))
+
+
+def compute_rfs(
+        spike_times, spike_clusters, stimulus_times, stimulus, lags=8, binsize=0.025, n_jobs=1):
     """
     Compute receptive fields from locally sparse noise stimulus for all recorded neurons; uses a
     PSTH-like approach that averages responses from each neuron for each pixel flip
@@ -23,66 +135,134 @@ def compute_rfs(spike_times, spike_clusters, stimulus_times, stimulus, lags=8, b
         temporal dimension of receptive field
     binsize : float, optional
         length of each lag (seconds)
+    n_jobs : int, optional
+        number of threads the flipped frames are split across; -1 uses all cores. Results do not
+        depend on `n_jobs`
 
     Returns
     -------
-    dict
-        "on" and "off" receptive fields (values are lists); each rf is shape (lags, y_pix, x_pix)
+    ReceptiveFields
+        "on" and "off" receptive fields; each rf is shape (lags + 1, y_pix, x_pix)
 
     """
 
-    from brainbox.processing import bincount2D
-
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids, cluster_idxs = np.unique(spike_clusters, return_inverse=True)
     n_clusters = len(cluster_ids)
     _, y_pix, x_pix = stimulus.shape
+    n_pix = y_pix * x_pix
     stimulus = stimulus.astype('float')
-    subs = ['on', 'off']
-    rfs = {sub: np.zeros(shape=(n_clusters, y_pix, x_pix, lags + 1)) for sub in subs}
-    flips = {sub: np.zeros(shape=(y_pix, x_pix)) for sub in subs}
+    subs = ReceptiveFields.subs
 
     gray = np.median(stimulus)
-    # loop over time points
-    for i, t in enumerate(stimulus_times):
-        # skip first frame since we're looking for pixels that flipped
-        if i == 0:
-            continue
-        # find pixels that flipped
-        frame_change = stimulus[i, :, :] - gray
-        ys, xs = np.where((frame_change != 0) & (stimulus[i - 1, :, :] == gray))
-        # loop over changed pixels
-        for y, x in zip(ys, xs):
-            if frame_change[y, x] > 0:  # gray -> white
-                sub = 'on'
-            else:  # black -> white
-                sub = 'off'
-            # bin spikes in the binsize*lags seconds following this flip
-            t_beg = t
-            t_end = t + binsize * lags
-            idxs_t = (spike_times >= t_beg) & (spike_times < t_end)
-            binned_spikes, _, cluster_idxs = bincount2D(
-                spike_times[idxs_t], spike_clusters[idxs_t], xbin=binsize, xlim=[t_beg, t_end])
-            # insert these binned spikes into the rfs
-            _, cluster_idxs, _ = np.intersect1d(cluster_ids, cluster_idxs, return_indices=True)
-            rfs[sub][cluster_idxs, y, x, :] += binned_spikes
-            # record flip
-            flips[sub][y, x] += 1
+    # find pixels that flipped (skip first frame since we're looking for pixels that flipped)
+    frame_change = stimulus[1:, :, :] - gray
+    i_frames, ys, xs = np.where((frame_change != 0) & (stimulus[:-1, :, :] == gray))
+    # gray -> white flips go into the "on" rows, gray -> black flips into the "off" rows
+    i_subs = (frame_change[i_frames, ys, xs] < 0).astype(np.int64)
+    i_pixels = np.ravel_multi_index((i_subs, ys, xs), dims=(len(subs), y_pix, x_pix))
+    # record flips
+    flips = np.bincount(i_pixels, minlength=len(subs) * n_pix)
+
+    # bin spikes in the binsize*lags seconds following each frame that contains a flip
+    frames, i_windows = np.unique(i_frames + 1, return_inverse=True)
+    t_beg = np.asarray(stimulus_times)[frames]
+    t_end = t_beg + binsize * lags
+    if np.any(np.diff(spike_times) < 0):
+        isort = np.argsort(spike_times, kind='stable')
+        spike_times = spike_times[isort]
+        cluster_idxs = cluster_idxs[isort]
+    w_idxs, s_idxs = _get_spikes_in_windows(spike_times, t_beg, t_end)
+    lag_idxs = np.floor((spike_times[s_idxs] - t_beg[w_idxs]) / binsize).astype(np.int64)
+    bin_idxs = cluster_idxs[s_idxs] * (lags + 1) + lag_idxs
+
+    # insert the binned spikes of each frame into the rfs of all pixels that flipped on it
+    rfs = _accumulate_chunks(
+        partial(_insert_chunk, w_idxs=w_idxs, bin_idxs=bin_idxs, i_windows=i_windows,
+                i_pixels=i_pixels),
+        shape=(len(subs) * n_pix, n_clusters * (lags + 1)), n_items=len(frames),
+        chunk_size=None, n_jobs=n_jobs)
 
     # normalize spikes by number of flips
-    for sub in rfs:
-        for y in range(y_pix):
-            for x in range(x_pix):
-                if flips[sub][y, x] != 0:
-                    rfs[sub][:, y, x, :] /= flips[sub][y, x]
+    rfs[flips != 0] /= flips[flips != 0][:, None]
 
-    # turn into list
-    rfs_list = {}
-    for sub in subs:
-        rfs_list[sub] = [np.transpose(rfs[sub][i, :, :, :], (2, 0, 1)) for i in range(n_clusters)]
-    return rfs_list
+    # package as (sub, cluster, lag, y, x)
+    rfs = np.reshape(rfs, (len(subs), y_pix, x_pix, n_clusters, lags + 1))
+    return ReceptiveFields(np.transpose(rfs, (0, 3, 4, 1, 2)), cluster_ids=cluster_ids)
 
 
-def compute_rfs_corr(spike_times, spike_clusters, stimulus_times, stimulus, lags=8, binsize=0.025):
+def _insert_chunk(w0, w1, out, w_idxs, bin_idxs, i_windows, i_pixels):
+    """
+    Add the binned spikes of the flipped frames [w0, w1) to the rfs of the pixels that flipped on
+    them (see `compute_rfs`); `w_idxs` and `i_windows` must be sorted
+    """
+    from scipy.sparse import csr_matrix
+    p0, p1 = np.searchsorted(w_idxs, [w0, w1])
+    binned_spikes = csr_matrix(
+        (np.ones(p1 - p0), (w_idxs[p0:p1] - w0, bin_idxs[p0:p1])), shape=(w1 - w0, out.shape[1]))
+    f0, f1 = np.searchsorted(i_windows, [w0, w1])
+    flipped = csr_matrix(
+        (np.ones(f1 - f0), (i_pixels[f0:f1], i_windows[f0:f1] - w0)),
+        shape=(out.shape[0], w1 - w0))
+    out += (flipped @ binned_spikes).toarray()
+
+
+def _accumulate_chunks(func, shape, n_items, chunk_size=None, n_jobs=1):
+    """
+    Sum the contributions of consecutive chunks of items (time bins or frames) into a single array;
+    chunks are optionally split across a pool of threads
+
+    Parameters
+    ----------
+    func : callable
+        `func(i0, i1, out)` adds the contribution of items [i0, i1) to the array `out`
+    shape : tuple
+        shape of the output array
+    n_items : int
+        total number of items
+    chunk_size : int or NoneType, optional
+        number of items per chunk; if `NoneType`, items are split evenly across jobs
+    n_jobs : int, optional
+        number of threads; -1 uses all cores. Threads share all inputs of `func` rather than
+        copying them, each thread accumulates its own contiguous range of chunks, and the partial
+        sums are added in chunk order so the output does not depend on scheduling
+
+    Returns
+    -------
+    np.ndarray
+        array of shape `shape`
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, n_items))
+    if chunk_size is None:
+        chunk_size = max(1, -(-n_items // n_jobs))
+    bounds = np.append(np.arange(0, n_items, chunk_size), n_items)
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+
+    def _accumulate(job_chunks):
+        out = np.zeros(shape=shape)
+        for i0, i1 in job_chunks:
+            func(i0, i1, out)
+        return out
+
+    if n_jobs == 1:
+        return _accumulate(chunks)
+    job_chunks = [
+        [chunks[i] for i in idxs] for idxs in np.array_split(np.arange(len(chunks)), n_jobs)]
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        outs = list(executor.map(_accumulate, job_chunks))
+    out = outs[0]
+    for partial_out in outs[1:]:
+        out += partial_out
+    return out
+
+
+def compute_rfs_corr(
+        spike_times, spike_clusters, stimulus_times, stimulus, lags=8, binsize=0.025,
+        chunk_size=None, n_jobs=1):
     """
     Compute receptive fields from locally sparse noise stimulus for all recorded neurons; uses a
     reverse correlation approach.
@@ -101,111 +281,241 @@ def compute_rfs_corr(spike_times, spike_clusters, stimulus_times, stimulus, lags
         temporal dimension of receptive field
     binsize : float, optional
         length of each lag (seconds)
+    chunk_size : int or NoneType, optional
+        number of time bins of binned spikes held in memory at once; peak memory then scales with
+        `chunk_size * n_clusters` instead of the length of the stimulus period. If `NoneType`, all
+        bins are processed at once (split evenly across jobs). Results do not depend on
+        `chunk_size`
+    n_jobs : int, optional
+        number of threads the chunks are split across; -1 uses all cores. Results do not depend
+        on `n_jobs`
 
     Returns
     -------
-    dict
-        "on" and "off" receptive fields (values are lists); each rf is shape (lags, y_pix, x_pix)
+    ReceptiveFields
+        "on" and "off" receptive fields; each rf is shape (lags + 1, y_pix, x_pix)
 
     """
 
-    from brainbox.processing import bincount2D
-    from scipy.signal import correlate
-
-    # bin spikes
+    # bin spikes; bins are the same as those of `brainbox.processing.bincount2D`, but spike counts
+    # are only expanded into a dense (n_clusters, n_bins) matrix one chunk of bins at a time
+    spike_times = np.asarray(spike_times)
     indx_t = (spike_times > np.min(stimulus_times)) & \
              (spike_times < np.max(stimulus_times))
-    binned_spikes, ts_binned_spikes, cluster_ids = bincount2D(
-        spike_times[indx_t], spike_clusters[indx_t], xbin=binsize)
+    spike_times = spike_times[indx_t]
+    cluster_ids, spike_clusters = np.unique(
+        np.asarray(spike_clusters)[indx_t], return_inverse=True)
+    t_min = np.min(spike_times)
+    ts_binned_spikes = np.arange(t_min, np.max(spike_times) + binsize / 2, binsize)
+    spike_bins = np.floor((spike_times - t_min) / binsize).astype(np.int64)
     n_clusters = len(cluster_ids)
+    n_bins = len(ts_binned_spikes)
+    # order spikes by bin so that each chunk is a contiguous slice
+    i_sort = np.argsort(spike_bins, kind='stable')
+    spike_bins = spike_bins[i_sort]
+    spike_clusters = spike_clusters[i_sort]
 
     _, y_pix, x_pix = stimulus.shape
+    n_pix = y_pix * x_pix
     stimulus = stimulus.astype('float')
     gray = np.median(stimulus)
 
-    subs = ['on', 'off']
-    rfs = {sub: np.zeros(shape=(n_clusters, y_pix, x_pix, lags + 1)) for sub in subs}
-
-    # for indexing output of convolution
-    i_end = binned_spikes.shape[1]
-    i_beg = i_end - lags
-
-    for sub in subs:
-        for y in range(y_pix):
-            for x in range(x_pix):
-                # find times that pixels flipped
-                diffs = np.concatenate([np.diff(stimulus[:, y, x]), [0]])
-                if sub == 'on':  # gray -> white
-                    changes = (diffs > 0) & (stimulus[:, y, x] == gray)
-                else:
-                    changes = (diffs < 0) & (stimulus[:, y, x] == gray)
-                t_change = np.where(changes)[0]
-
-                # put on same timescale as neural activity
-                binned_stim = np.zeros(shape=ts_binned_spikes.shape)
-                for t in t_change:
-                    stim_time = stimulus_times[t]
-                    # find nearest time in binned spikes
-                    idx = np.argmin((ts_binned_spikes - stim_time) ** 2)
-                    binned_stim[idx] = 1
-
-                for n in range(n_clusters):
-                    # cross correlate signal with spiking activity
-                    # NOTE: scipy's correlate function is appx two orders of
-                    # magnitude faster than numpy's correlate function on
-                    # relevant data size; perhaps scipy uses FFT? Not in docs.
-                    cc = correlate(binned_stim, binned_spikes[n, :], mode='full')
-                    rfs[sub][n, y, x, :] = cc[i_beg:i_end + 1]
-
-    # turn into list
-    rfs_list = {}
-    for sub in subs:
-        rfs_list[sub] = [np.transpose(rfs[sub][i, :, :, :], (2, 0, 1)) for i in range(n_clusters)]
-    return rfs_list
-
-
-def compute_rf_svds(rfs, scale='none'):
+    subs = ReceptiveFields.subs
+
+    # find times that pixels flipped
+    diffs = np.concatenate([np.diff(stimulus, axis=0), np.zeros((1, y_pix, x_pix))])
+    changes = np.stack([
+        (diffs > 0) & (stimulus == gray),  # gray -> white
+        (diffs < 0) & (stimulus == gray)])  # gray -> black
+    i_subs, t_change, ys, xs = np.where(changes)
+    i_pixels = np.ravel_multi_index((i_subs, ys, xs), dims=(len(subs), y_pix, x_pix))
+
+    # put on same timescale as neural activity; a pixel flips at most once per bin
+    idxs = _find_nearest(ts_binned_spikes, np.asarray(stimulus_times)[t_change])
+    i_pixels, idxs = np.divmod(np.unique(i_pixels * n_bins + idxs), n_bins)
+    i_sort = np.argsort(idxs, kind='stable')
+    i_pixels = i_pixels[i_sort]
+    idxs = idxs[i_sort]
+
+    # cross correlate flips with spiking activity of all clusters at once, only computing the
+    # lags that are kept: lag `i` holds the spikes `lags - 1 - i` bins after each flip
+    rfs = _accumulate_chunks(
+        partial(_correlate_chunk, spike_bins=spike_bins, spike_clusters=spike_clusters,
+                i_pixels=i_pixels, idxs=idxs),
+        shape=(len(subs) * n_pix, n_clusters, lags + 1), n_items=n_bins,
+        chunk_size=None if chunk_size is None else int(chunk_size), n_jobs=n_jobs)
+
+    # package as (sub, cluster, lag, y, x)
+    rfs = np.reshape(rfs, (len(subs), y_pix, x_pix, n_clusters, lags + 1))
+    return ReceptiveFields(np.transpose(rfs, (0, 3, 4, 1, 2)), cluster_ids=cluster_ids)
+
+
+def _correlate_chunk(c0, c1, out, spike_bins, spike_clusters, i_pixels, idxs):
+    """
+    Add the cross correlation of pixel flips with the spikes in bins [c0, c1) to `out` (see
+    `compute_rfs_corr`); `spike_bins` and `idxs` must be sorted
+    """
+    from scipy.sparse import csr_matrix
+    n_rows, n_clusters, n_lags = out.shape
+    lags = n_lags - 1
+    # spike counts of all clusters in bins [c0, c1)
+    s0, s1 = np.searchsorted(spike_bins, [c0, c1])
+    binned_spikes = np.bincount(
+        spike_clusters[s0:s1] * (c1 - c0) + spike_bins[s0:s1] - c0,
+        minlength=n_clusters * (c1 - c0)).reshape(n_clusters, c1 - c0)
+    # flips that fall in the chunk for at least one lag
+    f0, f1 = np.searchsorted(idxs, [c0 - lags + 1, c1 + 1])
+    for i in range(n_lags):
+        idxs_lag = idxs[f0:f1] + lags - 1 - i - c0
+        valid = (idxs_lag >= 0) & (idxs_lag < c1 - c0)
+        binned_stim = csr_matrix(
+            (np.ones(np.sum(valid)), (i_pixels[f0:f1][valid], idxs_lag[valid])),
+            shape=(n_rows, c1 - c0))
+        out[:, :, i] += binned_stim @ binned_spikes.T
+
+
+def _find_nearest(bin_times, times):
+    """
+    Find the index of the nearest entry of `bin_times` for each entry of `times`; ties are resolved
+    towards the earlier bin
+
+    Parameters
+    ----------
+    bin_times : np.ndarray
+        sorted array of bin times
+    times : np.ndarray
+        array of times to look up
+
+    Returns
+    -------
+    np.ndarray
+        array of indices into `bin_times` with the same shape as `times`
+
+    """
+    idxs = np.clip(np.searchsorted(bin_times, times), 1, len(bin_times) - 1)
+    prev_is_nearer = (bin_times[idxs - 1] - times) ** 2 <= (bin_times[idxs] - times) ** 2
+    return idxs - prev_is_nearer
+
+
+def get_rfs(
+        spike_times, spike_clusters, stimulus_times, stimulus, method='corr', lags=8,
+        binsize=0.025, chunk_size=None, n_jobs=1, cache_dir=None, use_cache=True):
+    """
+    Compute receptive fields with either `compute_rfs` or `compute_rfs_corr`, reusing results
+    cached on disk; the cache is keyed on the spikes, the stimulus, `method`, `lags`, `binsize`
+    and `RFS_CACHE_VERSION`
+
+    Parameters
+    ----------
+    spike_times : array-like
+        array of spike times
+    spike_clusters : array-like
+        array of cluster ids associated with each entry of `spike_times`
+    stimulus_times : array-like
+        array of stimulus presentation times with shape (M,)
+    stimulus : np.ndarray
+        array of pixel values wtih shape (M, y_pix, x_pix)
+    method : str, optional
+        method for calculating receptive fields
+        'sta': method used in Durand et al 2016 (`compute_rfs`)
+        'corr': reverse correlation method (`compute_rfs_corr`)
+    lags : int, optional
+        temporal dimension of receptive field
+    binsize : float, optional
+        length of each lag (seconds)
+    chunk_size : int or NoneType, optional
+        number of time bins processed at once by the `'corr'` method; does not affect results
+    n_jobs : int, optional
+        number of threads used to compute the rfs; -1 uses all cores. Does not affect results
+    cache_dir : str or Path or NoneType, optional
+        root cache directory; if `NoneType`, `cache.DEFAULT_CACHE_DIR` is used
+    use_cache : bool, optional
+        `False` always recomputes the rfs and does not write them to the cache
+
+    Returns
+    -------
+    ReceptiveFields
+        "on" and "off" receptive fields; each rf is shape (lags + 1, y_pix, x_pix)
+
+    """
+
+    if method not in ('sta', 'corr'):
+        raise NotImplementedError('The %s method to compute rfs is not implemented' % method)
+
+    spike_times = np.asarray(spike_times)
+    spike_clusters = np.asarray(spike_clusters)
+    if use_cache:
+        key = hash_inputs(
+            spike_times, spike_clusters, stimulus_times, stimulus, method=method, lags=lags,
+            binsize=binsize, version=RFS_CACHE_VERSION)
+        path = get_cache_path('rfs', key, cache_dir=cache_dir)
+        if path.exists():
+            return ReceptiveFields.load(path)
+
+    if method == 'sta':
+        rfs = compute_rfs(
+            spike_times, spike_clusters, stimulus_times, stimulus, lags=lags, binsize=binsize,
+            n_jobs=n_jobs)
+    else:
+        rfs = compute_rfs_corr(
+            spike_times, spike_clusters, stimulus_times, stimulus, lags=lags, binsize=binsize,
+            chunk_size=chunk_size, n_jobs=n_jobs)
+
+    if use_cache:
+        save_to_cache(path, rfs.save)
+    return rfs
+
+
+def compute_rf_svds(rfs, scale='none', dtype='float64'):
     """
     Perform SVD on the spatiotemporal rfs and return the first spatial and first temporal
-    components. Used for denoising purposes.
+    components. Used for denoising purposes. Only the leading singular triplet is computed, for all
+    clusters at once, from the eigendecomposition of the (n_bins, n_bins) temporal covariance.
 
     Parameters
     ----------
-    rfs : dict
-        dictionary of "on" and "off" receptive fields (values are lists); each rf is of shape
-        (n_bins, y_pix, x_pix) - output of `compute_rfs` or `compute_rfs_corr`
+    rfs : ReceptiveFields or dict
+        "on" and "off" receptive fields; each rf is of shape (n_bins, y_pix, x_pix) - output of
+        `compute_rfs` or `compute_rfs_corr`
     scale : str, optional
         scale either the spatial or temporal component (or neither) by the singular value
         'spatial' | 'temporal' | 'none'
+    dtype : str, optional
+        floating point precision of the computation and of the outputs
+        'float64' | 'float32'
 
     Returns
     -------
     dict
-        dict with 'spatial' and 'temporal' keys; the values are lists of the specified
-        components, on for each input rf
+        dict with 'spatial' and 'temporal' keys; the values are `ReceptiveFields` whose "on" and
+        "off" arrays are of shape (n_clusters, y_pix, x_pix) and (n_clusters, n_bins) respectively
 
     """
-
-    from scipy.linalg import svd
-    rfs_svd = {key1: {key2: [] for key2 in rfs.keys()} for key1 in ['spatial', 'temporal']}
-    n_bins, y_pix, x_pix = rfs['on'][0].shape
+    rfs = ReceptiveFields.from_dict(rfs)
+    rfs_svd = {key1: {} for key1 in ['spatial', 'temporal']}
     # loop over rf type
     for sub_type, subs in rfs.items():
-        # loop over clusters
-        for sub in subs:
-            # reshape take PSTH and rearrange into n_pixels x n_bins
-            sub_reshaped = np.reshape(sub, (n_bins, y_pix * x_pix))
-            # svd
-            u, s, v = svd(sub_reshaped.T)
-            # keep first spatial dim and temporal trace
-            sign = -1 if np.median(v[0, :]) < 0 else 1
-            rfs_svd['spatial'][sub_type].append(sign * np.reshape(u[:, 0], (y_pix, x_pix)))
-            if scale == 'spatial':
-                rfs_svd['spatial'][sub_type][-1] *= s[0]
-            rfs_svd['temporal'][sub_type].append(sign * v[0, :])
-            if scale == 'temporal':
-                rfs_svd['temporal'][sub_type][-1] *= s[0]
-    return rfs_svd
+        subs = np.asarray(subs, dtype=dtype)
+        n_clusters, n_bins, y_pix, x_pix = subs.shape
+        # reshape take PSTH and rearrange into n_bins x n_pixels for each cluster
+        subs_reshaped = np.reshape(subs, (n_clusters, n_bins, y_pix * x_pix))
+        # first right singular vector is the top eigenvector of the temporal covariance
+        evals, evecs = np.linalg.eigh(subs_reshaped @ np.swapaxes(subs_reshaped, 1, 2))
+        s = np.sqrt(np.clip(evals[:, -1], 0, None))
+        v = evecs[:, :, -1]
+        # corresponding left singular vector; rfs without any variance have no spatial component
+        u = np.einsum('nbp,nb->np', subs_reshaped, v)
+        u = np.divide(u, s[:, None], out=np.zeros_like(u), where=s[:, None] > 0)
+        # keep first spatial dim and temporal trace
+        sign = np.where(np.median(v, axis=1) < 0, -1, 1).astype(dtype)
+        rfs_svd['spatial'][sub_type] = np.reshape(sign[:, None] * u, (n_clusters, y_pix, x_pix))
+        if scale == 'spatial':
+            rfs_svd['spatial'][sub_type] *= s[:, None, None]
+        rfs_svd['temporal'][sub_type] = sign[:, None] * v
+        if scale == 'temporal':
+            rfs_svd['temporal'][sub_type] *= s[:, None]
+    return {key1: ReceptiveFields.from_dict(rfs_svd[key1], cluster_ids=rfs.cluster_ids)
+            for key1 in rfs_svd.keys()}
 
 
 def find_peak_responses(rfs):
@@ -214,60 +524,76 @@ def find_peak_responses(rfs):
 
     Parameters
     ----------
-    rfs : dict
-        dictionary of receptive fields (output of `compute_rfs`); each rf is of size
-        (lags, y_pix, y_pix)
+    rfs : ReceptiveFields or dict
+        receptive fields (output of `compute_rfs`); each rf is of size (lags + 1, y_pix, y_pix)
 
     Returns
     -------
-    dict
-        dictionary containing peak rf time slice for both "on" and "off" rfs (values are lists)
+    ReceptiveFields
+        peak rf time slice for both "on" and "off" rfs; each rf is of size (y_pix, x_pix)
 
     """
-    rfs_peak = {key: [] for key in rfs.keys()}
-    # loop over rf type
-    for sub_type, subs in rfs.items():
-        # loop over clusters
-        for sub in subs:
-            # max over space for each time point
-            s_max = np.max(sub, axis=(1, 2))
-            # take time point with largest max
-            rfs_peak[sub_type].append(sub[np.argmax(s_max), :, :])
-    return rfs_peak
+    rfs = ReceptiveFields.from_dict(rfs)
+    # max over space for each time point
+    s_max = np.max(rfs.data, axis=(3, 4))
+    # take time point with largest max
+    i_peak = np.argmax(s_max, axis=2)
+    rfs_peak = np.take_along_axis(rfs.data, i_peak[:, :, None, None, None], axis=2)[:, :, 0]
+    return ReceptiveFields(rfs_peak, cluster_ids=rfs.cluster_ids)
 
 
 def interpolate_rfs(rfs, bin_scale=0.5):
     """
-    Bilinear interpolation of receptive fields
+    Bilinear interpolation of receptive fields; all clusters are interpolated at once and values
+    outside the original pixel grid are taken from the nearest pixel (as in `interp2d`)
 
     Parameters
     ----------
-    rfs : dict
-        dictionary of receptive fields (single time slice)
+    rfs : ReceptiveFields or dict
+        receptive fields (single time slice); each rf is of shape (y_pix, x_pix)
     bin_scale : float, optional
-        scaling factor to determine number of bins for interpolation; e.g. bin_scale=0.5 doubles the
-        number of bins in both directions
+        scaling factor to determine number of bins for interpolation; e.g. bin_scale=0.5 doubles
+        the number of bins in both directions
 
     Returns
     -------
-    dict
-        dictionary of interpolated receptive fields (values are lists)
+    ReceptiveFields
+        interpolated receptive fields; each rf is of shape (y_pix_new, x_pix_new)
 
     """
-    from scipy.interpolate import interp2d
-    rfs_interp = {'on': [], 'off': []}
-    y_pix, x_pix = rfs['on'][0].shape
-    x_grid = np.arange(x_pix)
-    y_grid = np.arange(y_pix)
-    x_grid_new = np.arange(-0.5, x_pix, bin_scale)
-    y_grid_new = np.arange(-0.5, y_pix, bin_scale)
-    # loop over rf type
-    for sub_type, subs in rfs.items():
-        # loop over clusters
-        for sub in subs:
-            f = interp2d(y_grid, x_grid, sub)
-            rfs_interp[sub_type].append(f(y_grid_new, x_grid_new))
-    return rfs_interp
+    rfs = ReceptiveFields.from_dict(rfs)
+    y_pix, x_pix = rfs.data.shape[-2:]
+    weights_y = _get_interp_weights(y_pix, np.arange(-0.5, y_pix, bin_scale))
+    weights_x = _get_interp_weights(x_pix, np.arange(-0.5, x_pix, bin_scale))
+    # interpolate both rf types for all clusters at once
+    return ReceptiveFields(weights_y @ rfs.data @ weights_x.T, cluster_ids=rfs.cluster_ids)
+
+
+def _get_interp_weights(n_pix, grid):
+    """
+    Linear interpolation matrix that maps values on pixels `0, ..., n_pix - 1` onto `grid`; grid
+    points outside of the pixel range take the value of the nearest pixel
+
+    Parameters
+    ----------
+    n_pix : int
+        number of pixels in the original grid
+    grid : np.ndarray
+        new grid locations (in pixel units)
+
+    Returns
+    -------
+    np.ndarray
+        array of shape (len(grid), n_pix)
+
+    """
+    grid = np.clip(grid, 0, n_pix - 1)
+    idxs = np.clip(np.floor(grid).astype(np.int64), 0, max(n_pix - 2, 0))
+    frac = grid - idxs
+    weights = np.zeros(shape=(len(grid), n_pix))
+    weights[np.arange(len(grid)), idxs] = 1 - frac
+    weights[np.arange(len(grid)), np.minimum(idxs + 1, n_pix - 1)] += frac
+    return weights
 
 
 def extract_blob(array, y, x):
@@ -288,30 +614,29 @@ def extract_blob(array, y, x):
         list of blob indices
 
     """
+    from collections import deque
     y_pix, x_pix = array.shape
     blob = []
-    pixels_to_check = [[y, x]]
+    processed_pix = {(y, x)}
+    pixels_to_check = deque([(y, x)])
     while len(pixels_to_check) != 0:
-        pixel = pixels_to_check.pop(0)
-        blob.append(pixel)
-        y = pixel[0]
-        x = pixel[1]
+        y, x = pixels_to_check.popleft()
+        blob.append([y, x])
         # check N, S, E, W
-        for idx in [[y - 1, x], [y + 1, x], [y, x + 1], [y, x - 1]]:
-            if idx in blob:
+        for yi, xi in [(y - 1, x), (y + 1, x), (y, x + 1), (y, x - 1)]:
+            if (yi, xi) in processed_pix:
                 continue
             # check boundaries
-            xi = idx[0]
-            yi = idx[1]
-            if (0 <= yi < y_pix) and (0 <= xi < x_pix):
-                if array[xi, yi] and idx not in pixels_to_check:
-                    pixels_to_check.append(idx)
+            if (0 <= yi < y_pix) and (0 <= xi < x_pix) and array[yi, xi]:
+                processed_pix.add((yi, xi))
+                pixels_to_check.append((yi, xi))
     return blob
 
 
 def extract_blobs(array):
     """
-    Extract contiguous blobs of `True` values in a boolean array
+    Extract contiguous blobs of `True` values in a boolean array; blobs are ordered by their first
+    pixel in raster order, as are the pixels within each blob
 
     Parameters
     ----------
@@ -324,31 +649,25 @@ def extract_blobs(array):
         list of lists of blob indices
 
     """
-    y_pix, x_pix = array.shape
-    processed_pix = []
-    blobs = []
-    for y in range(y_pix):
-        for x in range(x_pix):
-            # find a blob starting at this point
-            if not array[y, x]:
-                continue
-            if [y, x] in processed_pix:
-                continue
-            blob = extract_blob(array, y, x)
-            for pixel in blob:
-                processed_pix.append(pixel)
-            blobs.append(blob)
-    return blobs
+    from scipy.ndimage import label
+    labels, n_blobs = label(array)
+    ys, xs = np.nonzero(labels)
+    blob_labels = labels[ys, xs]
+    isort = np.argsort(blob_labels, kind='stable')
+    splits = np.cumsum(np.bincount(blob_labels, minlength=n_blobs + 1)[1:-1])
+    pixels = np.c_[ys[isort], xs[isort]]
+    return [blob.tolist() for blob in np.split(pixels, splits)] if n_blobs else []
 
 
 def find_contiguous_pixels(rfs, threshold=0.35):
     """
-    Calculate number of contiguous pixels in a thresholded version of the receptive field
+    Calculate number of contiguous pixels in a thresholded version of the receptive field; all
+    clusters are labelled in a single pass
 
     Parameters
     ----------
-    rfs : dict
-        dictionary of receptive fields (single time slice)
+    rfs : ReceptiveFields or dict
+        receptive fields (single time slice); each rf is of shape (y_pix, x_pix)
     threshold : float, optional
         pixels below this fraction of the maximum firing are set to zero before contiguous pixels
         are calculated
@@ -359,28 +678,32 @@ def find_contiguous_pixels(rfs, threshold=0.35):
         dictionary of contiguous pixels for each rf type ("on and "off")
 
     """
+    from scipy.ndimage import label
+
+    rfs = ReceptiveFields.from_dict(rfs)
 
     # store results
-    n_clusters = len(rfs['on'])
-    max_fr = np.zeros(n_clusters)
-    contig_pixels = {'on': np.zeros(n_clusters), 'off': np.zeros(n_clusters)}
+    contig_pixels = {sub_type: np.zeros(rfs.n_clusters) for sub_type in rfs.keys()}
 
     # compute max firing rate for each cluster
-    for sub_type, subs in rfs.items():
-        for n, sub in enumerate(subs):
-            max_fr[n] = np.max([max_fr[n], np.max(sub)])
+    max_fr = np.maximum(0, np.max(rfs.data, axis=(0, 2, 3)))
+
+    # pixels are connected to their N, S, E, W neighbors within the same cluster only
+    structure = np.zeros(shape=(3, 3, 3), dtype=bool)
+    structure[1, :, 1] = True
+    structure[1, 1, :] = True
 
     # compute max number of contiguous pixels
     for sub_type, subs in rfs.items():
-        for n, sub in enumerate(subs):
-            # compute rf mask using threshold
-            rf_mask = sub > (threshold * max_fr[n])
-            # extract contiguous pixels (blobs)
-            blobs = extract_blobs(rf_mask)
-            # save size of largest blob
-            if len(blobs) != 0:
-                contig_pixels[sub_type][n] = np.max(
-                    [len(blob) for blob in blobs])
+        # compute rf mask using threshold
+        rf_mask = subs > (threshold * max_fr[:, None, None])
+        # extract contiguous pixels (blobs)
+        labels, n_blobs = label(rf_mask, structure=structure)
+        blob_sizes = np.bincount(labels.ravel(), minlength=n_blobs + 1)
+        blob_clusters = np.zeros(n_blobs + 1, dtype=np.int64)
+        blob_clusters[labels[rf_mask]] = np.nonzero(rf_mask)[0]
+        # save size of largest blob
+        np.maximum.at(contig_pixels[sub_type], blob_clusters[1:], blob_sizes[1:])
 
     return contig_pixels
 
@@ -394,8 +717,8 @@ def compute_rf_areas(rfs, bin_scale=0.5, threshold=0.35):
 
     Parameters
     ----------
-    rfs : dict
-        dictionary of receptive fields (dict keys are 'on' and 'off'); output of `compute_rfs`
+    rfs : ReceptiveFields or dict
+        "on" and "off" receptive fields; output of `compute_rfs` or `compute_rfs_corr`
     bin_scale : float, optional
         scaling for interpolation (e.g. 0.5 doubles bins)
     threshold : float, optional
@@ -492,9 +815,68 @@ def plot_rf_distributions(rf_areas, plot_type='box'):
     return splt
 
 
+def histograms_rf_areas(
+        session_path, clusters=None, params={'bin_sz': .05, 'lags': 4, 'method': 'corr'},
+        cache_dir=None, use_cache=True):
+    """
+    Load spikes and rf stimulus info, compute rfs and plot histograms of the "on" and "off" rf
+    areas. Must have ibllib package in python path in order to use alf loaders.
+
+    Parameters
+    ----------
+    session_path : str
+        absolute path to the alf directory of the session
+    clusters : array-like or NoneType, optional
+        clusters to use in rf calculation; if `NoneType`, all clusters are used
+    params : dict, optional
+        'bin_sz': width of bins in seconds; 'lags': number of bins for calculating rfs; 'method':
+        method for calculating rfs ('corr' | 'sta')
+    cache_dir : str or Path or NoneType, optional
+        root directory of the rf cache (see `get_rfs`)
+    use_cache : bool, optional
+        `False` always recomputes the rfs
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+        figure handle
+
+    """
+
+    import alf.io as ioalf
+
+    # load objects
+    spikes = ioalf.load_object(session_path, 'spikes')
+    stim_info = load_stim_info(session_path)
+    rf_stim_times = stim_info['rf_stim_times']
+    rf_stim = stim_info['rf_stim'].astype('float')
+
+    # get mask for spikes
+    if clusters is None:  # assume we are using all clusters
+        mask = np.ones(spikes['times'].shape, dtype=bool)
+        print('All clusters are shown')
+    else:  # use given subset of clusters
+        mask = np.isin(spikes['clusters'], clusters)
+        print('Only a subset of all clusters is shown')
+
+    print('computing receptive fields...', end='')
+    rfs = get_rfs(
+        spikes.times[mask], spikes.clusters[mask], rf_stim_times, rf_stim,
+        method=params['method'], lags=params['lags'], binsize=params['bin_sz'],
+        cache_dir=cache_dir, use_cache=use_cache)
+    print('done')
+
+    print('computing receptive field areas...', end='')
+    rf_areas = compute_rf_areas(rfs)
+    print('done')
+
+    fig = plot_rf_distributions(rf_areas, plot_type='hist')
+    return fig
+
+
 def plot_rfs_by_depth_wrapper(
         alf_path, axes=None, cluster_ids=[], method='corr', binsize=0.025, lags=8, n_depths=30,
-        use_svd=False):
+        use_svd=False, chunk_size=None, n_jobs=1, cache_dir=None, use_cache=True):
     """
     Wrapper function to load spikes and rf stimulus info, aggregate clusters over depths, compute
     rfs, and plot spatial components as a function of linear depth on probe. Must have ibllib
@@ -520,6 +902,16 @@ def plot_rfs_by_depth_wrapper(
         number of bins to divide probe depth into for aggregating clusters
     use_svd : bool, optional
         `True` plots 1st spatial SVD component of rf; `False` plots time lag with peak response
+    chunk_size : int or NoneType, optional
+        number of time bins processed at once by the `'corr'` method to bound memory usage; if
+        `NoneType`, all bins are processed at once
+    n_jobs : int, optional
+        number of threads used to compute the rfs of all depths and both polarities; -1 uses all
+        cores
+    cache_dir : str or Path or NoneType, optional
+        root directory of the rf cache (see `get_rfs`)
+    use_cache : bool, optional
+        `False` always recomputes the rfs
 
     Returns
     -------
@@ -533,9 +925,9 @@ def plot_rfs_by_depth_wrapper(
     # load objects
     spikes = ioalf.load_object(alf_path, 'spikes')
     clusters = ioalf.load_object(alf_path, 'clusters')
-    rfmap = ioalf.load_object(alf_path, '_iblcertif_.rfmap')
-    rf_stim_times = rfmap['rfmap.times.00']
-    rf_stim = rfmap['rfmap.stims.00'].astype('float')
+    stim_info = load_stim_info(alf_path)
+    rf_stim_times = stim_info['rf_stim_times']
+    rf_stim = stim_info['rf_stim'].astype('float')
 
     # combine clusters across similar depths
     min_depth = np.min(clusters['depths'])
@@ -555,16 +947,10 @@ def plot_rfs_by_depth_wrapper(
         clusters_agg[(lo_limit < depths_agg) & (depths_agg <= up_limit)] = d
 
     print('computing receptive fields...', end='')
-    if method == 'sta':
-        # method in Durand et al 2016
-        rfs = compute_rfs(
-            times_agg, clusters_agg, rf_stim_times, rf_stim, lags=lags, binsize=binsize)
-    elif method == 'corr':
-        # reverse correlation method
-        rfs = compute_rfs_corr(
-            times_agg, clusters_agg, rf_stim_times, rf_stim, lags=lags, binsize=binsize)
-    else:
-        raise NotImplementedError
+    rfs = get_rfs(
+        times_agg, clusters_agg, rf_stim_times, rf_stim, method=method, lags=lags,
+        binsize=binsize, chunk_size=chunk_size, n_jobs=n_jobs, cache_dir=cache_dir,
+        use_cache=use_cache)
 
     # get single spatial footprint of rf
     if use_svd:
@@ -584,8 +970,8 @@ def plot_rfs_by_depth(rfs, axes=None):
 
     Parameters
     ----------
-    rfs : dict
-        dict of "on" and "off" rfs (values are lists); each rf is of shape `(ypix, xpix)`
+    rfs : ReceptiveFields or dict
+        "on" and "off" rfs; each rf is of shape `(ypix, xpix)`
     axes : array of matplotlib axes or NoneType, optional
         matplotlib axes to plot into; if `NoneType`, a figure will be created and returned
 
@@ -641,21 +1027,12 @@ if __name__ == '__main__':
     rf_stim_times = rfmap['rfmap.times.00']
     rf_stim = rfmap['rfmap.stims.00'].astype('float')
 
-    # compute receptive fields
-    if METHOD == 'sta':
-        # method in Durand et al 2016; ~9 min for 700 units on a single cpu core
-        print('computing receptive fields...', end='')
-        rfs = compute_rfs(
-            spikes.times, spikes.clusters, rf_stim_times, rf_stim, lags=LAGS, binsize=BINSIZE)
-        print('done')
-    elif METHOD == 'corr':
-        # reverse correlation method; ~3 min for 700 units on a single cpu core
-        print('computing receptive fields...', end='')
-        rfs = compute_rfs_corr(
-            spikes.times, spikes.clusters, rf_stim_times, rf_stim, lags=LAGS, binsize=BINSIZE)
-        print('done')
-    else:
-        raise NotImplementedError('The %s method to compute rfs is not implemented' % METHOD)
+    # compute receptive fields; cached results are reused
+    print('computing receptive fields...', end='')
+    rfs = get_rfs(
+        spikes.times, spikes.clusters, rf_stim_times, rf_stim, method=METHOD, lags=LAGS,
+        binsize=BINSIZE)
+    print('done')
 
     print('computing receptive field areas...', end='')
     rf_areas = compute_rf_areas(rfs)
@@ -0,0 +1,117 @@
+"""
+Loading of the certification stimulus metadata ('_iblcertif_' alf objects) of a session.
+
+The metadata is parsed once per session and kept in memory, so that the figure functions called
+by `plot.gen_figures` share a single load. A cached entry is reused only as long as the
+'_iblcertif_' files it was parsed from keep the same names, sizes and modification times.
+"""
+
+from pathlib import Path
+import numpy as np
+try:
+    from cache import get_file_signature
+except ImportError:
+    from v1_protocol.cache import get_file_signature
+
+# resolved alf path -> (file signature, stimulus metadata)
+_STIM_INFO_CACHE = {}
+
+
+def _get_boundary_times(alf_path):
+    """
+    Start and end times of each stimulus type, from the '_iblcertif_*times*' files
+
+    Parameters
+    ----------
+    alf_path : Path
+
+    Returns
+    -------
+    dict
+        keys are stimulus type names (e.g. 'odsgratings.times.00'), values are [start, end]
+
+    """
+    boundary_times = {}
+    for f in alf_path.rglob('_iblcertif_*times*'):
+        name = '.'.join(f.name.split('.')[1:4])
+        times = np.load(f)
+        if times.ndim == 2:
+            boundary_times[name] = [times[0][0], times[-1][-1]]
+        elif times.ndim == 1:
+            boundary_times[name] = [times[0], times[-1]]
+    return boundary_times
+
+
+def _read_only(array):
+    array = np.asarray(array)
+    array.flags.writeable = False
+    return array
+
+
+def _parse_stim_info(alf_path):
+    """Load and parse the '_iblcertif_' alf objects of a session; see `load_stim_info`."""
+    import alf.io as ioalf
+    stim_info = {'boundary_times': _get_boundary_times(alf_path)}
+    epochs = {'beg': '00', 'end': '01'}
+    if any(alf_path.glob('_iblcertif_.odsgratings.*')):
+        gratings = ioalf.load_object(alf_path, '_iblcertif_.odsgratings')
+        stim_info['grating_times'] = {
+            epoch: _read_only(gratings['odsgratings.times.%s' % i])
+            for epoch, i in epochs.items()}
+        stim_info['grating_vals'] = {
+            epoch: _read_only(gratings['odsgratings.stims.%s' % i])
+            for epoch, i in epochs.items()}
+        stim_info['grating_epochs'] = {
+            epoch: (np.min(times), np.max(times))
+            for epoch, times in stim_info['grating_times'].items()}
+    if any(alf_path.glob('_iblcertif_.spontaneous.*')):
+        spontaneous = ioalf.load_object(alf_path, '_iblcertif_.spontaneous')
+        stim_info['spont_times'] = {
+            epoch: _read_only(spontaneous['spontaneous.times.%s' % i])
+            for epoch, i in epochs.items()}
+    if any(alf_path.glob('_iblcertif_.rfmap.*')):
+        rfmap = ioalf.load_object(alf_path, '_iblcertif_.rfmap')
+        stim_info['rf_stim_times'] = _read_only(rfmap['rfmap.times.00'])
+        stim_info['rf_stim'] = _read_only(rfmap['rfmap.stims.00'])
+    return stim_info
+
+
+def load_stim_info(alf_path, use_cache=True):
+    """
+    Load the certification stimulus metadata of a session
+
+    Parameters
+    ----------
+    alf_path : str or Path
+        path to the 'alf/probe' directory containing the '_iblcertif_' files
+    use_cache : bool, optional
+        whether to reuse the metadata parsed by a previous call for the same session; the cached
+        metadata is discarded if any '_iblcertif_' file was added, removed or modified since
+
+    Returns
+    -------
+    dict
+        - 'grating_times' (dict): keys 'beg', 'end' point to arrays of grating onset/offset times
+        - 'grating_vals' (dict): keys 'beg', 'end' point to arrays of grating orientations
+        - 'spont_times' (dict): keys 'beg', 'end' point to spontaneous activity periods
+        - 'grating_epochs' (dict): keys 'beg', 'end' point to the (start, end) times of the
+          grating epochs
+        - 'rf_stim_times' (array): times of the sparse noise frames
+        - 'rf_stim' (array): sparse noise frames
+        - 'boundary_times' (dict): [start, end] times of each stimulus type, as returned by
+          `complete_raster_depth_per_spike.get_stimulus_type_boundary_times`
+
+        Keys of stimuli whose '_iblcertif_' files are missing are left out. The arrays are
+        shared between calls and are therefore read-only; copy them before modifying them in
+        place.
+
+    """
+    alf_path = Path(alf_path).resolve()
+    signature = get_file_signature(alf_path.rglob('_iblcertif_*'))
+    if use_cache:
+        cached = _STIM_INFO_CACHE.get(alf_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    stim_info = _parse_stim_info(alf_path)
+    _STIM_INFO_CACHE[alf_path] = (signature, stim_info)
+    return stim_info
@@ -1,7 +1,7 @@
 
 
 from oneibl.one import ONE
-from plot import gen_figures
+from plot import gen_figures_batch
 
 # if you could also try just adding 'ibllib - brainbox', 'iblscripts - certification', and 'analysis - cert_master_fn' repositories (on those branches) to your python path
 import sys
@@ -11,4 +11,6 @@ sys.path.append('~/Documents/code/iblscripts')
 one = ONE()
 eid = one.search(subject='ZM_2104', date='2019-09-19', number=1)[0]
 one.load(eid, dataset_types=one.list(), clobber=False, download_only=True)
-gen_figures(eid, probe='probe_right', cluster_ids_summary=1)
+# equivalent to running, from the 'analysis' directory:
+#   python -m v1_protocol.plot --eids <eid> --probes probe_right --out-dir ~/v1cert_figs
+gen_figures_batch([eid], ['probe_right'], '~/v1cert_figs', one=one)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+for module in ['oneibl.one', 'alf.io', 'brainbox', 'ibllib.io']:
+    pytest.importorskip(module)
+from v1_protocol.plot import extract_waveforms_batch  # noqa: E402
+
+
+def test_extract_waveforms_batch_edges(tmp_path):
+    sr, n_ch_probe, n_samples = 30000, 4, 1000
+    # each sample holds its (1-based) index, on every channel
+    data = np.repeat(np.arange(1, n_samples + 1, dtype='int16')[:, None], n_ch_probe, axis=1)
+    ephys_file = tmp_path / 'raw.ap.bin'
+    data.tofile(ephys_file)
+    ts = np.array([0., 500 / sr, (n_samples - 1) / sr])  # first, middle and last samples
+    ch = np.array([1, 3])
+    wf, = extract_waveforms_batch(
+        str(ephys_file), [ts], [ch], t=2.0, sr=sr, n_ch_probe=n_ch_probe)
+    n = 30  # samples on each side of a timestamp
+    assert wf.shape == (3, 2 * n, 2)
+    # window of the first spike: zero-padded before the start of the recording
+    np.testing.assert_array_equal(wf[0, :n], 0)
+    np.testing.assert_array_equal(wf[0, n:, 0], np.arange(1, n + 1))
+    # window in the middle of the recording
+    np.testing.assert_array_equal(wf[1, :, 1], np.arange(501 - n, 501 + n))
+    # window of the last spike: zero-padded past the end of the recording
+    np.testing.assert_array_equal(wf[2, :n + 1, 0], np.arange(n_samples - n, n_samples + 1))
+    np.testing.assert_array_equal(wf[2, n + 1:], 0)
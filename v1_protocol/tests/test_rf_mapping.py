@@ -0,0 +1,27 @@
+import numpy as np
+
+from v1_protocol.rf_mapping import ReceptiveFields, compute_rf_svds
+
+
+def _random_rfs(dtype, n_clusters=5, n_bins=4, y_pix=3, x_pix=6):
+    rng = np.random.default_rng(0)
+    shape = (len(ReceptiveFields.subs), n_clusters, n_bins, y_pix, x_pix)
+    return ReceptiveFields(rng.standard_normal(shape).astype(dtype))
+
+
+def test_from_dict_keeps_float_precision():
+    rfs = {sub: np.zeros((2, 3, 4), dtype='float32') for sub in ReceptiveFields.subs}
+    assert ReceptiveFields.from_dict(rfs).data.dtype == np.float32
+    rfs = {sub: [np.zeros((3, 4), dtype=int)] * 2 for sub in ReceptiveFields.subs}
+    assert ReceptiveFields.from_dict(rfs).data.dtype == np.float64
+
+
+def test_compute_rf_svds_dtype():
+    for dtype in ['float32', 'float64']:
+        rfs_svd = compute_rf_svds(_random_rfs('float64'), dtype=dtype)
+        for key in ['spatial', 'temporal']:
+            assert rfs_svd[key].data.dtype == np.dtype(dtype)
+    rfs_svd_32 = compute_rf_svds(_random_rfs('float64'), dtype='float32')
+    rfs_svd_64 = compute_rf_svds(_random_rfs('float64'), dtype='float64')
+    np.testing.assert_allclose(
+        rfs_svd_32['temporal'].data, rfs_svd_64['temporal'].data, atol=1e-4)
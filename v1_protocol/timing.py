@@ -0,0 +1,120 @@
+"""
+Opt-in wall time and peak memory report of the consecutive stages of a computation (e.g. of
+`plot.gen_figures`).
+
+Peak memory is measured with `tracemalloc`, which traces the allocations made through Python
+(including numpy arrays) but slows down allocation-heavy code somewhat; the maximum resident set
+size of the process so far is reported as well, where the platform provides it.
+"""
+
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def _get_max_rss():
+    """Maximum resident set size of the process so far, in MB (NaN if unavailable)."""
+    if resource is None:
+        return float('nan')
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class StageTimer(object):
+    """
+    Records the wall time and peak memory of consecutive stages: each call to `start` ends the
+    current stage (if any) and starts a new one. A disabled timer does nothing, so that calls can
+    be left in place when no report is requested.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        whether to record anything
+
+    Examples
+    --------
+    >>> timer = StageTimer()
+    >>> timer.start('load')
+    >>> ...
+    >>> timer.start('compute')
+    >>> ...
+    >>> timer.stop()
+    >>> timer.report()
+
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self._stage = None
+        self._t0 = None
+        self._started_tracing = False
+
+    def start(self, stage):
+        """
+        End the current stage and start a new one
+
+        Parameters
+        ----------
+        stage : str
+            name of the new stage
+
+        """
+        if not self.enabled:
+            return
+        self.stop()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        elif hasattr(tracemalloc, 'reset_peak'):  # python >= 3.9
+            tracemalloc.reset_peak()
+        self._stage = stage
+        self._t0 = time.perf_counter()
+
+    def stop(self):
+        """End the current stage; tracing of memory allocations ends with it."""
+        if not self.enabled or self._stage is None:
+            return
+        wall_time = time.perf_counter() - self._t0
+        _, peak = tracemalloc.get_traced_memory()
+        self.stages.append({
+            'stage': self._stage, 'wall_time_s': wall_time, 'peak_mem_mb': peak / 2 ** 20,
+            'max_rss_mb': _get_max_rss()})
+        self._stage = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        """
+        Table of the recorded stages
+
+        Returns
+        -------
+        pd.DataFrame
+            one row per stage, in order, with columns 'stage', 'wall_time_s' (wall time),
+            'peak_mem_mb' (peak memory allocated during the stage, on top of the memory held
+            when it started) and 'max_rss_mb' (maximum resident set size of the process at the
+            end of the stage)
+
+        """
+        return pd.DataFrame(
+            self.stages, columns=['stage', 'wall_time_s', 'peak_mem_mb', 'max_rss_mb'])
+
+    def save(self, path):
+        """
+        Save the report as a csv file
+
+        Parameters
+        ----------
+        path : str or Path
+
+        """
+        self.report().to_csv(path, index=False, float_format='%.3f')
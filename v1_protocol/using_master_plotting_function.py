@@ -342,3 +342,23 @@ m, cluster_sets, _ = v1_plot.gen_figures(
     summary_metrics = ['feat_vars', 'spks_missed', 'isi_viol', 'max_drift_depth',
                        'cum_drift_depth', 'max_drift_amp', 'cum_drift_amp', 'pres_ratio', 'cv_fr'],
     summary_metrics_params={'fr_hist_win': 0.5, 'fr_ma_win': 2})
+
+
+# Example 5: Generate only the grating response summary and unit metrics summary figures for
+# several sessions at once, without displaying them, and save them (and a table of the unit
+# metrics) in the home 'v1cert_figs' directory, in one subdirectory per session and probe. Only
+# the computations needed for these figures are run.
+# -------------------------------------------------------------------------------------------------
+
+one = ONE()
+eids = [one.search(subject='ZM_2104', date='2019-09-19', number=1)[0],
+        one.search(subject='CSHL_020', date='2019-12-03', number=1)[0]]
+probes = ['probe_right', 'probe00']
+save_dir = Path.joinpath(Path.home(), 'v1cert_figs')
+
+outputs = v1_plot.gen_figures_batch(
+    eids, probes, save_dir, figures=['gr_summary', 'um_summary'], one=one, seed=0)
+
+# The same can be run from a terminal, from the 'analysis' directory:
+#   python -m v1_protocol.plot --eids <eid1> <eid2> --probes probe_right probe00
+#       --out-dir ~/v1cert_figs --figures gr_summary um_summary --seed 0